@@ -9,7 +9,8 @@ import getpass
 import click
 
 from bugwarrior.config import (
-    get_data_path, get_keyring, load_config, ServiceConfig)
+    aslist, get_data_path, get_keyring, load_config, prefetch_passwords,
+    ServiceConfig)
 from bugwarrior.services import aggregate_issues, get_service
 from bugwarrior.db import (
     get_defined_udas_as_strings,
@@ -51,7 +52,9 @@ def _try_load_config(main_section, interactive=False):
 @click.option('--interactive', is_flag=True)
 @click.option('--debug', is_flag=True,
               help='Do not use multiprocessing (which breaks pdb).')
-def pull(dry_run, flavor, interactive, debug):
+@click.option('--refresh-metadata', is_flag=True,
+              help='Ignore the server metadata cached by earlier pulls.')
+def pull(dry_run, flavor, interactive, debug, refresh_metadata):
     """ Pull down tasks from forges and add them to your taskwarrior tasks.
 
     Relies on configuration in bugwarriorrc
@@ -60,12 +63,18 @@ def pull(dry_run, flavor, interactive, debug):
     try:
         main_section = _get_section_name(flavor)
         config = _try_load_config(main_section, interactive)
+        config.refresh_metadata = refresh_metadata
 
         lockfile_path = os.path.join(get_data_path(config, main_section),
                                      'bugwarrior.lockfile')
         lockfile = PIDLockFile(lockfile_path)
         lockfile.acquire(timeout=10)
         try:
+            # Resolve passwords once, rather than in every worker.
+            prefetch_passwords(
+                config, main_section,
+                aslist(config.get(main_section, 'targets')))
+
             # Get all the issues.  This can take a while.
             issue_generator = aggregate_issues(config, main_section, debug)
 
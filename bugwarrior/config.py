@@ -1,10 +1,13 @@
 from future import standard_library
 standard_library.install_aliases()
 import codecs
+import json
 from six.moves import configparser
+import multiprocessing
 import os
 import subprocess
 import sys
+import time
 
 import six
 
@@ -49,6 +52,20 @@ def get_keyring():
     return keyring
 
 
+# Keyring lookups are made by the workers themselves, as only the services
+# know which login to look up.  They are made one at a time, as keyring
+# backends asking gpg-agent for several of them at once make it fumble.
+# Worker processes do not share this lock unless they were forked, so
+# `aggregate_issues` hands them its own through `use_keyring_lock`.
+_keyring_lock = multiprocessing.Lock()
+
+
+def use_keyring_lock(lock):
+    """ Make the keyring lookups of this process wait on the given lock. """
+    global _keyring_lock
+    _keyring_lock = lock
+
+
 def get_service_password(service, username, oracle=None, interactive=False):
     """
     Retrieve the sensitive password for a service by:
@@ -73,20 +90,21 @@ def get_service_password(service, username, oracle=None, interactive=False):
 
     password = None
     if not oracle or oracle == "@oracle:use_keyring":
-        keyring = get_keyring()
-        password = keyring.get_password(service, username)
-        if interactive and password is None:
-            # -- LEARNING MODE: Password is not stored in keyring yet.
-            oracle = "@oracle:ask_password"
-            password = get_service_password(service, username,
-                                            oracle, interactive=True)
-            if password:
-                keyring.set_password(service, username, password)
-        elif not interactive and password is None:
-            log.error(
-                'Unable to retrieve password from keyring. '
-                'Re-run in interactive mode to set a password'
-            )
+        with _keyring_lock:
+            keyring = get_keyring()
+            password = keyring.get_password(service, username)
+            if interactive and password is None:
+                # -- LEARNING MODE: Password is not stored in keyring yet.
+                oracle = "@oracle:ask_password"
+                password = get_service_password(service, username,
+                                                oracle, interactive=True)
+                if password:
+                    keyring.set_password(service, username, password)
+            elif not interactive and password is None:
+                log.error(
+                    'Unable to retrieve password from keyring. '
+                    'Re-run in interactive mode to set a password'
+                )
     elif interactive and oracle == "@oracle:ask_password":
         prompt = "%s password: " % service
         password = getpass.getpass(prompt)
@@ -113,6 +131,83 @@ def oracle_eval(command):
                 command=command, error=p.stderr.read().strip()))
 
 
+# The keyring service under which `prefetch_passwords` caches the results of
+# ``@oracle:eval``, keyed by oracle.
+ORACLE_CACHE_KEYRING_SERVICE = 'bugwarrior-oracle-cache'
+
+
+def get_cached_oracle_password(oracle, ttl):
+    """ Return the result of an ``@oracle:eval`` cached in the keyring less
+    than ttl seconds ago, or None. """
+    with _keyring_lock:
+        cached = get_keyring().get_password(
+            ORACLE_CACHE_KEYRING_SERVICE, oracle)
+    try:
+        cached = json.loads(cached)
+    except (TypeError, ValueError):  # Missing or corrupted entry.
+        return None
+    if time.time() - cached['time'] < ttl:
+        return cached['password']
+
+
+def cache_oracle_password(oracle, password):
+    with _keyring_lock:
+        get_keyring().set_password(
+            ORACLE_CACHE_KEYRING_SERVICE, oracle,
+            json.dumps({'password': password, 'time': time.time()}))
+
+
+def prefetch_passwords(config, main_section, targets):
+    """ Resolve the password oracles of targets before any worker starts.
+
+    The passwords are stored in ``config.passwords``, keyed by target and
+    option, where workers look them up.  So is the error of an oracle which
+    failed, for the worker of that target to raise.  Oracles are resolved
+    one at a time,
+    as workers all asking gpg-agent at once makes it fumble and tell some of
+    them incomplete things.  With ``password_cache_ttl`` set, the results of
+    ``@oracle:eval`` are also kept in the keyring for that many seconds.
+    """
+    config.passwords = {}
+
+    ttl = None
+    if config.has_option(main_section, 'password_cache_ttl'):
+        ttl = asint(config.get(main_section, 'password_cache_ttl'))
+    # Results of @oracle:eval, keyed by oracle.
+    evaluated = {}
+
+    for target in targets:
+        service = get_service(config.get(target, 'service'))
+        for option in config.options(target):
+            oracle = config.get(target, option)
+            if not oracle:
+                continue
+
+            try:
+                if oracle.startswith('@oracle:eval:'):
+                    if oracle not in evaluated and ttl:
+                        evaluated[oracle] = get_cached_oracle_password(
+                            oracle, ttl)
+                    if evaluated.get(oracle) is None:
+                        evaluated[oracle] = oracle_eval(oracle[13:])
+                        if ttl:
+                            cache_oracle_password(oracle, evaluated[oracle])
+                    password = evaluated[oracle]
+                elif (oracle == '@oracle:ask_password' and
+                        getattr(config, 'interactive', False)):
+                    service_config = ServiceConfig(
+                        service.CONFIG_PREFIX, config, target)
+                    password = get_service_password(
+                        service.get_keyring_service(service_config), None,
+                        oracle=oracle, interactive=True)
+                else:
+                    continue
+            except (Exception, SystemExit) as e:
+                # Only the target relying on the password fails.
+                password = e
+            config.passwords[(target, option)] = password
+
+
 def load_example_rc():
     fname = os.path.join(
         os.path.dirname(__file__),
@@ -173,6 +268,21 @@ def validate_config(config, main_section):
         if target not in config.sections():
             die("No [%s] section found." % target)
 
+    if config.has_option(main_section, 'max_workers'):
+        try:
+            max_workers = asint(config.get(main_section, 'max_workers'))
+        except ValueError:
+            max_workers = -1
+        if max_workers is not None and max_workers < 0:
+            die("max_workers in [%s] must be a positive integer." %
+                main_section)
+
+    if config.has_option(main_section, 'worker_pool'):
+        worker_pool = config.get(main_section, 'worker_pool')
+        if worker_pool not in ('processes', 'threads'):
+            die("worker_pool in [%s] must be 'processes' or 'threads'." %
+                main_section)
+
     # Validate each target one by one.
     for target in targets:
         service = config.get(target, 'service')
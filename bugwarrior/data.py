@@ -1,5 +1,6 @@
 import os
 import json
+import re
 
 from lockfile.pidlockfile import PIDLockFile
 
@@ -10,6 +11,9 @@ class BugwarriorData(object):
         self.lockfile = os.path.join(data_path, 'bugwarrior-data.lockfile')
         self.path = data_path
 
+    def get_cache(self, name):
+        return BugwarriorCache(self.path, name)
+
     def get_data(self):
         with open(self.datafile, 'r') as jsondata:
             return json.load(jsondata)
@@ -33,3 +37,62 @@ class BugwarriorData(object):
                     json.dump(data, jsondata)
 
             os.chmod(self.datafile, 0o600)
+
+
+class BugwarriorCache(object):
+    """ A JSON document kept in its own file in the data directory.
+
+    Unlike the values in `BugwarriorData`, caches can grow large, so each
+    one is stored separately and only read by the worker which needs it.
+    """
+    def __init__(self, data_path, name):
+        name = re.sub(r'[^\w.-]', '_', name)
+        self.cachefile = os.path.join(data_path, '%s.cache' % name)
+        self.lockfile = os.path.join(data_path, '%s-cache.lockfile' % name)
+
+    def load(self):
+        try:
+            with open(self.cachefile, 'r') as jsondata:
+                return json.load(jsondata)
+        except (IOError, ValueError):  # Missing or corrupted cache.
+            return {}
+
+    def save(self, value):
+        with PIDLockFile(self.lockfile):
+            tmpfile = self.cachefile + '.tmp'
+            with open(tmpfile, 'w') as jsondata:
+                json.dump(value, jsondata)
+            os.chmod(tmpfile, 0o600)
+            os.rename(tmpfile, self.cachefile)
+
+
+class StampedCache(object):
+    """ Values kept in a `BugwarriorCache` along with a stamp, such as the
+    comments of an issue along with the time it was last updated.
+
+    A value is only computed again once its stamp changed.  Only the values
+    used since the cache was loaded are saved, so the others expire.  Without
+    a cache, values are always computed.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.cached = {}
+        self.used = {}
+
+    def load(self):
+        self.cached = self.cache.load()
+
+    def get(self, key, stamp, compute):
+        """ Return the value cached for key if it was cached with stamp, or
+        the result of `compute()` otherwise.  Stamps containing None never
+        match, as they cannot tell whether the value changed. """
+        cached = self.cached.get(key)
+        if cached and None not in stamp and cached['stamp'] == stamp:
+            value = cached['value']
+        else:
+            value = compute()
+        self.used[key] = {'stamp': stamp, 'value': value}
+        return value
+
+    def save(self):
+        self.cache.save(self.used)
@@ -5,17 +5,26 @@ from builtins import zip
 from builtins import object
 
 from six.moves.configparser import NoOptionError, NoSectionError
+import collections
+import hashlib
 import json
 import os
 import re
+import datetime
 import subprocess
 import sys
+import tempfile
+import uuid
 
 import requests
 import dogpile.cache
+import pytz
 import six
 from taskw import TaskWarriorShellout
 from taskw.exceptions import TaskwarriorError
+from taskw.fields.annotationarray import Annotation
+from taskw.task import Task
+from taskw.utils import DATE_FORMAT
 
 from bugwarrior.config import asbool, get_taskrc_path, aslist
 from bugwarrior.notifications import send_notification
@@ -26,6 +35,9 @@ log = logging.getLogger(__name__)
 
 MARKUP = "(bw)"
 
+# Maximum number of tasks written by a single `task import` invocation.
+IMPORT_CHUNK_SIZE = 500
+
 # In Python 2.3 through 2.7, the stdlib dbm module include a berkeley db
 # interface, which was used by default by dogpile.cache.  In Python3, the
 # berkeley db module was removed which means that cache files created by
@@ -98,53 +110,54 @@ def hamdist(str1, str2):
     return diffs
 
 
-def get_managed_task_uuids(tw, key_list):
-    expected_task_ids = set([])
-    for keys in key_list.values():
-        tasks = tw.filter_tasks({
-            'and': [('%s.any' % key, None) for key in keys],
-            'or': [
-                ('status', 'pending'),
-                ('status', 'waiting'),
-            ],
-        })
-        expected_task_ids = expected_task_ids | set([
-            task['uuid'] for task in tasks
-        ])
-
-    return expected_task_ids
+def get_managed_tasks(tw):
+    """ Export every pending and waiting task with a single ``task`` call. """
+    return tw.filter_tasks({
+        'or': [
+            ('status', 'pending'),
+            ('status', 'waiting'),
+        ],
+    })
 
 
-def make_unique_identifier(keys, issue):
-    """ For a given issue, make an identifier from its unique keys.
+def build_task_index(tasks, keys):
+    """ Index exported tasks on every set of unique keys.
 
-    This is not the same as the taskwarrior uuid, which is assigned
-    only once the task is created.
+    Matching issues against this index replaces the per-issue
+    ``filter_tasks`` calls we used to shell out for.
 
     :params:
-    * `keys`: A list of lists of keys to use for uniquely identifying
-      an issue.
-    * `issue`: An instance of a subclass of `bugwarrior.services.Issue`.
+    * `tasks`: An iterable of tasks as returned by `get_managed_tasks`.
+    * `keys`: A dict mapping service names to the list of keys used for
+      uniquely identifying their issues (see `build_key_list`).
 
     :returns:
-    * A single string UUID.
+    * A dict mapping `(service, values)` tuples to sets of task UUIDs.
     """
-    for service, key_list in six.iteritems(keys):
-        if all([key in issue for key in key_list]):
-            subset = dict([(key, issue[key]) for key in key_list])
-            return json.dumps(subset, sort_keys=True)
-    raise RuntimeError("Could not determine unique identifier for %s" % issue)
+    index = collections.defaultdict(set)
+    for task in tasks:
+        for service, key_list in six.iteritems(keys):
+            values = [task.get(key) for key in key_list]
+            if any(value is None or value == '' for value in values):
+                continue
+            identifier = (service, tuple(
+                six.text_type(value) for value in values))
+            index[identifier].add(task['uuid'])
+    return index
 
 
-def find_taskwarrior_uuid(tw, keys, issue):
-    """ For a given issue issue, find its local taskwarrior UUID.
+def get_managed_task_uuids(index):
+    """ Return the UUIDs of every task referenced by a task index. """
+    return set().union(*index.values())
 
-    Assembles a list of task IDs existing in taskwarrior
-    matching the supplied issue (`issue`) on the combination of any
-    set of supplied unique identifiers (`keys`).
+
+def make_unique_identifier(keys, issue):
+    """ For a given issue, make an identifier from its unique keys.
+
+    This is not the same as the taskwarrior uuid, which is assigned
+    only once the task is created.
 
     :params:
-    * `tw`: An instance of `taskw.TaskWarriorShellout`
     * `keys`: A list of lists of keys to use for uniquely identifying
       an issue.  To clarify the "list of lists" behavior, assume that
       there are two services, one having a single primary key field
@@ -159,6 +172,28 @@ def find_taskwarrior_uuid(tw, keys, issue):
 
     * `issue`: An instance of a subclass of `bugwarrior.services.Issue`.
 
+    :returns:
+    * A hashable `(service, values)` tuple, as used by `build_task_index`.
+    """
+    for service, key_list in six.iteritems(keys):
+        if all([key in issue for key in key_list]):
+            return (service, tuple(
+                six.text_type(issue[key]) for key in key_list))
+    raise RuntimeError("Could not determine unique identifier for %s" % issue)
+
+
+def find_taskwarrior_uuid(index, identifier, issue):
+    """ For a given issue issue, find its local taskwarrior UUID.
+
+    Looks up the tasks existing in taskwarrior matching the unique
+    identifier of the supplied issue (`issue`).
+
+    :params:
+    * `index`: A task index as returned by `build_task_index`.
+    * `identifier`: The identifier of the issue, as returned by
+      `make_unique_identifier`.
+    * `issue`: An instance of a subclass of `bugwarrior.services.Issue`.
+
     :returns:
     * A single string UUID.
 
@@ -170,20 +205,7 @@ def find_taskwarrior_uuid(tw, keys, issue):
     if not issue['description']:
         raise ValueError('Issue %s has no description.' % issue)
 
-    possibilities = set([])
-
-    for service, key_list in six.iteritems(keys):
-        if any([key in issue for key in key_list]):
-            results = tw.filter_tasks({
-                'and': [("%s.is" % key, issue[key]) for key in key_list],
-                'or': [
-                    ('status', 'pending'),
-                    ('status', 'waiting'),
-                ],
-            })
-            possibilities = possibilities | set([
-                task['uuid'] for task in results
-            ])
+    possibilities = set(index.get(identifier, ()))
 
     if len(possibilities) == 1:
         return possibilities.pop()
@@ -252,6 +274,175 @@ def merge_left(field, local_task, remote_issue, hamming=False):
             new_count, field, len(local_task[field]),))
 
 
+def get_import_annotations(annotations):
+    """ Serialize annotations the way ``task import`` expects them.
+
+    Annotations exported from taskwarrior keep their original entry date.
+    New annotations are given distinct entry dates, since taskwarrior
+    stores annotations keyed by their entry date.
+    """
+    used = set(
+        annotation.entry for annotation in annotations
+        if isinstance(annotation, Annotation) and annotation.entry
+    )
+    entry = datetime.datetime.now(pytz.utc).replace(microsecond=0)
+    serialized = []
+    for annotation in annotations:
+        if isinstance(annotation, Annotation) and annotation.entry:
+            annotation_entry = annotation.entry
+        else:
+            while entry in used:
+                entry += datetime.timedelta(seconds=1)
+            annotation_entry = entry
+            used.add(entry)
+        serialized.append({
+            'entry': annotation_entry.astimezone(pytz.utc).strftime(
+                DATE_FORMAT),
+            'description': six.text_type(annotation),
+        })
+    return serialized
+
+
+def serialize_task_for_import(tw, task, status=None):
+    """ Serialize a task or issue dict into a ``task import`` record.
+
+    :params:
+    * `tw`: An instance of `taskw.TaskWarriorShellout`
+    * `task`: A `taskw.task.Task` to be modified, or an issue dict for a
+      task to be created.
+    * `status`: Optionally override the status of the task.
+
+    :returns:
+    * A dict ready to be serialized to JSON.  Tasks with an ``end`` date
+      are imported as completed.
+    """
+    if not isinstance(task, Task):
+        stub = Task({}, udas=tw.config.get_udas())
+        stub.update(task)
+        task = stub
+    annotations = task.get('annotations') or []
+
+    serialized = dict(
+        (key, value) for key, value in six.iteritems(task.serialized())
+        if value not in (None, '', [])
+    )
+    # These are computed by taskwarrior and cannot be imported.
+    for key in ('id', 'urgency', 'modified'):
+        serialized.pop(key, None)
+
+    if annotations:
+        serialized['annotations'] = get_import_annotations(annotations)
+    if 'uuid' not in serialized:
+        serialized['uuid'] = six.text_type(uuid.uuid4())
+
+    if status:
+        serialized['status'] = status
+    elif serialized.get('end'):
+        serialized['status'] = 'completed'
+    else:
+        serialized.setdefault('status', 'pending')
+
+    if serialized['status'] == 'completed' and not serialized.get('end'):
+        serialized['end'] = datetime.datetime.now(pytz.utc).strftime(
+            DATE_FORMAT)
+
+    return serialized
+
+
+def _task_import(tw, tasks):
+    """ Run a single ``task import`` for a list of serialized tasks.
+
+    taskw has no public way to run ``task import``, so this is the one place
+    relying on its private ``TaskWarriorShellout._execute(*args)``.  That
+    was last checked against taskw 2.0.0.
+    """
+    with tempfile.NamedTemporaryFile(
+        mode='w', suffix='.json', delete=False
+    ) as f:
+        for task in tasks:
+            f.write(json.dumps(task) + '\n')
+    try:
+        tw._execute('import', f.name)
+    finally:
+        os.remove(f.name)
+
+
+def refresh_tasks(tw, uuids):
+    """ Export the given tasks again, keyed by uuid.
+
+    ``task import`` replaces whole tasks, so tasks are written from a fresh
+    export rather than the one `synchronize` started with, which may be
+    minutes old by then.
+    """
+    uuids = list(uuids)
+    tasks = {}
+    for offset in range(0, len(uuids), IMPORT_CHUNK_SIZE):
+        chunk = uuids[offset:offset + IMPORT_CHUNK_SIZE]
+        for task in tw.filter_tasks({
+            'or': [('uuid', six.text_type(task_uuid)) for task_uuid in chunk],
+        }):
+            tasks[task['uuid']] = task
+    return tasks
+
+
+def rebase_task(fresh_task, task):
+    """ Apply the changes made to an exported task onto a fresh export of
+    it, keeping the edits made locally in the meantime.
+
+    Annotations and tags only get the values which were added; other fields
+    are overwritten.
+    """
+    for field, (old, new) in six.iteritems(task.get_changes(keep=True)):
+        if field in ('annotations', 'tags'):
+            current = list(fresh_task.get(field) or [])
+            new = current + [
+                value for value in new or []
+                if value not in (old or []) and value not in current
+            ]
+        fresh_task[field] = new
+    return fresh_task
+
+
+def import_tasks(tw, writes):
+    """ Apply task writes with as few ``task import`` calls as possible.
+
+    Writes are imported in chunks of `IMPORT_CHUNK_SIZE`.  Should a chunk
+    be refused, its tasks are re-imported one at a time so that errors can
+    be reported per task.  This is safe because every serialized task
+    carries its uuid, making imports idempotent.
+
+    :params:
+    * `tw`: An instance of `taskw.TaskWarriorShellout`
+    * `writes`: A list of `(action, task)` tuples where `action` is one of
+      'add', 'modify' or 'close' and `task` was serialized by
+      `serialize_task_for_import`.
+
+    Returns the uuids of the tasks which could not be written.
+    """
+    failed = []
+    for offset in range(0, len(writes), IMPORT_CHUNK_SIZE):
+        chunk = writes[offset:offset + IMPORT_CHUNK_SIZE]
+        try:
+            _task_import(tw, [task for _, task in chunk])
+        except TaskwarriorError as e:
+            if len(chunk) == 1:
+                action, task = chunk[0]
+                log.exception("Unable to %s task: %s" % (action, e.stderr))
+                failed.append(task['uuid'])
+                continue
+            log.warn("Batch import failed, retrying tasks one by one.")
+            for write in chunk:
+                failed.extend(import_tasks(tw, [write]))
+    return failed
+
+
+def get_record_hash(issue_dict):
+    """ Return a digest of an upstream record, telling whether it changed
+    since the last sync. """
+    serialized = json.dumps(issue_dict, sort_keys=True, default=six.text_type)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
 def run_hooks(conf, name):
     if conf.has_option('hooks', name):
         pre_import = aslist(conf.get('hooks', name))
@@ -267,6 +458,8 @@ def run_hooks(conf, name):
 
 
 def synchronize(issue_generator, conf, main_section, dry_run=False):
+    from bugwarrior.services import SERVICE_FINISHED_ERROR
+
     def _bool_option(section, option, default):
         try:
             return asbool(conf.get(section, option))
@@ -302,17 +495,105 @@ def synchronize(issue_generator, conf, main_section, dry_run=False):
 
     merge_annotations = _bool_option(main_section, 'merge_annotations', True)
     merge_tags = _bool_option(main_section, 'merge_tags', True)
+    incremental_sync = _bool_option(main_section, 'incremental_sync', False)
+
+    # Export the managed tasks once and match every incoming issue against
+    # an in-memory index instead of shelling out to `task` per issue.
+    tasks = dict((task['uuid'], task) for task in get_managed_tasks(tw))
+    task_index = build_task_index(tasks.values(), key_list)
 
     issue_updates = {
         'new': [],
         'existing': [],
         'changed': [],
-        'closed': get_managed_task_uuids(tw, key_list),
+        'closed': get_managed_task_uuids(task_index),
     }
 
-    seen = []
+    notreally = ' (not really)' if dry_run else ''
+    totals = {'new': 0, 'changed': 0, 'closed': 0}
+
+    # Digests of the records synced last time and this time, along with the
+    # uuid of their task, keyed by unique identifier.
+    cached_hashes = {}
+    fetched_hashes = {}
+    failed_uuids = set()
+    if incremental_sync:
+        hash_cache = conf.data.get_cache('sync-hashes-' + main_section)
+        cached_hashes = hash_cache.load()
+        uuids_by_text = dict(
+            (six.text_type(task_uuid), task_uuid) for task_uuid in tasks)
+
+    def flush():
+        """ Write the new and changed tasks matched so far. """
+        # All writes are collected here and applied with `task import`.
+        writes = []
+
+        # Add new issues
+        log.info("Adding %i tasks", len(issue_updates['new']))
+        for issue in issue_updates['new']:
+            log.info(u"Adding task %s%s", issue['description'], notreally)
+            if dry_run:
+                continue
+            if notify:
+                send_notification(issue, 'Created', conf)
+
+            writes.append(('add', serialize_task_for_import(tw, issue)))
+
+        log.info("Updating %i tasks", len(issue_updates['changed']))
+        fresh_tasks = {}
+        if not dry_run:
+            fresh_tasks = refresh_tasks(
+                tw, [issue['uuid'] for issue in issue_updates['changed']])
+        for issue in issue_updates['changed']:
+            changes = '; '.join([
+                '{field}: {f} -> {t}'.format(
+                    field=field,
+                    f=repr(ch[0]),
+                    t=repr(ch[1])
+                )
+                for field, ch in six.iteritems(issue.get_changes(keep=True))
+            ])
+            log.info(
+                "Updating task %s, %s; %s%s",
+                six.text_type(issue['uuid']),
+                issue['description'],
+                changes,
+                notreally
+            )
+            if dry_run:
+                continue
+            if issue['uuid'] not in fresh_tasks:
+                log.warn("Task %s is gone, not updating it.", issue['uuid'])
+                continue
+
+            writes.append(('modify', serialize_task_for_import(
+                tw, rebase_task(fresh_tasks[issue['uuid']], issue))))
+
+        failed_uuids.update(import_tasks(tw, writes))
+
+        totals['new'] += len(issue_updates['new'])
+        totals['changed'] += len(issue_updates['changed'])
+        issue_updates['new'] = []
+        issue_updates['changed'] = []
+
+    failed_targets = []
+    seen = set()
     for issue in issue_generator:
 
+        # With `pipelined` enabled, `aggregate_issues` tells us whenever a
+        # target is done so that its updates land without waiting for the
+        # slower targets.
+        if isinstance(issue, tuple):
+            completion_type, args = issue
+            if completion_type == SERVICE_FINISHED_ERROR:
+                target, e = args
+                log.error(
+                    "Target [%s] failed (%s), its tasks will not be closed.",
+                    target, e)
+                failed_targets.append(target)
+            flush()
+            continue
+
         try:
             issue_dict = dict(issue)
             # We received this issue from The Internet, but we're not sure what
@@ -332,14 +613,32 @@ def synchronize(issue_generator, conf, main_section, dry_run=False):
                 issue_dict['priority'] = None
 
             # De-duplicate issues coming in
-            unique_identifier = make_unique_identifier(key_list, issue)
+            unique_identifier = make_unique_identifier(key_list, issue_dict)
             if unique_identifier in seen:
                 log.debug("Skipping.  Seen %s of %r" % (unique_identifier, issue))
                 continue
-            seen.append(unique_identifier)
-
-            existing_taskwarrior_uuid = find_taskwarrior_uuid(tw, key_list, issue)
-            _, task = tw.get_task(uuid=existing_taskwarrior_uuid)
+            seen.add(unique_identifier)
+
+            if incremental_sync:
+                hash_key = json.dumps(unique_identifier)
+                digest = get_record_hash(issue_dict)
+                cached = cached_hashes.get(hash_key)
+                # Unchanged upstream since the last sync, and its task is
+                # still around, so there is nothing to merge.
+                if (cached and cached[0] == digest and
+                        cached[1] in uuids_by_text):
+                    task_uuid = uuids_by_text[cached[1]]
+                    issue_updates['existing'].append(tasks[task_uuid])
+                    issue_updates['closed'].discard(task_uuid)
+                    fetched_hashes[hash_key] = cached
+                    continue
+
+            existing_taskwarrior_uuid = find_taskwarrior_uuid(
+                task_index, unique_identifier, issue_dict)
+            task = tasks[existing_taskwarrior_uuid]
+            if incremental_sync:
+                fetched_hashes[hash_key] = [
+                    digest, six.text_type(existing_taskwarrior_uuid)]
 
             # Drop static fields from the upstream issue.  We don't want to
             # overwrite local changes to fields we declare static.
@@ -372,53 +671,22 @@ def synchronize(issue_generator, conf, main_section, dry_run=False):
         except NotFound:
             issue_updates['new'].append(issue_dict)
 
-    notreally = ' (not really)' if dry_run else ''
-    # Add new issues
-    log.info("Adding %i tasks", len(issue_updates['new']))
-    for issue in issue_updates['new']:
-        log.info(u"Adding task %s%s", issue['description'], notreally)
-        if dry_run:
-            continue
-        if notify:
-            send_notification(issue, 'Created', conf)
-
-        try:
-            new_task = tw.task_add(**issue)
-            if 'end' in issue and issue['end']:
-                tw.task_done(uuid=new_task['uuid'])
-        except TaskwarriorError as e:
-            log.exception("Unable to add task: %s" % e.stderr)
-
-    log.info("Updating %i tasks", len(issue_updates['changed']))
-    for issue in issue_updates['changed']:
-        changes = '; '.join([
-            '{field}: {f} -> {t}'.format(
-                field=field,
-                f=repr(ch[0]),
-                t=repr(ch[1])
-            )
-            for field, ch in six.iteritems(issue.get_changes(keep=True))
-        ])
-        log.info(
-            "Updating task %s, %s; %s%s",
-            six.text_type(issue['uuid']),
-            issue['description'],
-            changes,
-            notreally
-        )
-        if dry_run:
-            continue
+    flush()
 
-        try:
-            _, updated_task = tw.task_update(issue)
-            if 'end' in issue and issue['end']:
-                tw.task_done(uuid=updated_task['uuid'])
-        except TaskwarriorError as e:
-            log.exception("Unable to modify task: %s" % e.stderr)
+    # Tasks of services with a failed target may simply not have been
+    # fetched, so we cannot tell whether they were closed upstream.
+    failed_services = set(conf.get(target, 'service') for target in failed_targets)
+    for (service, _), uuids in six.iteritems(task_index):
+        if service in failed_services:
+            issue_updates['closed'] -= uuids
 
+    writes = []
     log.info("Closing %i tasks", len(issue_updates['closed']))
+    fresh_tasks = {}
+    if not dry_run:
+        fresh_tasks = refresh_tasks(tw, issue_updates['closed'])
     for issue in issue_updates['closed']:
-        _, task_info = tw.get_task(uuid=issue)
+        task_info = tasks[issue]
         log.info(
             "Completing task %s %s%s",
             issue,
@@ -427,31 +695,50 @@ def synchronize(issue_generator, conf, main_section, dry_run=False):
         )
         if dry_run:
             continue
+        # Tasks completed or deleted locally in the meantime stay as they are.
+        task_info = fresh_tasks.get(issue)
+        if not task_info or task_info['status'] not in ('pending', 'waiting'):
+            continue
 
         if notify:
             send_notification(task_info, 'Completed', conf)
 
-        try:
-            tw.task_done(uuid=issue)
-        except TaskwarriorError as e:
-            log.exception("Unable to close task: %s" % e.stderr)
+        writes.append((
+            'close',
+            serialize_task_for_import(tw, task_info, status='completed'),
+        ))
+
+    import_tasks(tw, writes)
+    totals['closed'] = len(issue_updates['closed'])
+
+    if incremental_sync and not dry_run:
+        # Tasks which failed to update have to be diffed again next time.
+        hash_cache.save(dict(
+            (key, value) for key, value in six.iteritems(fetched_hashes)
+            if value[1] not in failed_uuids
+        ))
 
     # Send notifications
     if notify:
         only_on_new_tasks = _bool_option('notifications', 'only_on_new_tasks', False)
-        if not only_on_new_tasks or len(issue_updates['new']) + len(issue_updates['changed']) + len(issue_updates['closed']) > 0:
+        if not only_on_new_tasks or totals['new'] + totals['changed'] + totals['closed'] > 0:
             send_notification(
                 dict(
                     description="New: %d, Changed: %d, Completed: %d" % (
-                        len(issue_updates['new']),
-                        len(issue_updates['changed']),
-                        len(issue_updates['closed'])
+                        totals['new'],
+                        totals['changed'],
+                        totals['closed']
                     )
                 ),
                 'bw_finished',
                 conf,
             )
 
+    if failed_targets:
+        raise RuntimeError(
+            "critical error in target(s) '{}'".format(
+                "', '".join(failed_targets)))
+
 
 def build_key_list(targets):
     from bugwarrior.services import get_service
@@ -2,21 +2,30 @@ from __future__ import unicode_literals
 from builtins import str
 from builtins import object
 
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import multiprocessing
+import os
+import threading
 import time
 
 from pkg_resources import iter_entry_points
 
 from dateutil.parser import parse as parse_date
 from dateutil.tz import tzlocal
-from jinja2 import Template
+from jinja2 import Environment
 import pytz
+import requests
+from requests.adapters import HTTPAdapter
 import six
+from six.moves import queue as thread_queue
+from six.moves.urllib.parse import urlparse
 
 from taskw.task import Task
 
-from bugwarrior.config import asbool, asint, aslist, die, get_service_password, ServiceConfig
+from bugwarrior.config import (
+    asbool, asint, aslist, die, get_service_password, use_keyring_lock,
+    ServiceConfig)
 from bugwarrior.db import MARKUP, URLShortener
 
 import logging
@@ -31,6 +40,103 @@ SERVICE_FINISHED_ERROR = 1
 # date string to be parsed as if it were in your local timezone
 LOCAL_TIMEZONE = 'LOCAL_TIMEZONE'
 
+# Templates are compiled once per process, and shared by all issues and
+# targets, rather than every time an issue is rendered.
+_template_environment = Environment()
+_templates = {}
+
+
+def get_template(source):
+    """ Return the compiled jinja template for source. """
+    if source not in _templates:
+        _templates[source] = _template_environment.from_string(source)
+    return _templates[source]
+
+
+def _copy_value(value):
+    """ Return a copy of a taskwarrior record value, if it can be modified.
+
+    Values stay plain lists and dicts, which can be pickled over to the
+    parent and stored as JSON.
+    """
+    if isinstance(value, (list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+
+# Number of rendered issues workers send to the parent at once.
+ISSUE_BATCH_SIZE = 100
+
+# Upper bound on the requests in flight to a single host, across all of the
+# service clients of a process.
+MAX_HOST_REQUESTS = 16
+
+# Upper bound on the hosts whose connections are kept alive at once.  With
+# worker threads, one process talks to the hosts of every target.
+MAX_HTTP_HOSTS = 100
+
+# The connection pool shared by the service clients of a process, and the
+# semaphores bounding the requests to each host.  Both are tied to the pid
+# they were created in, since connections cannot be shared with a fork.
+_http_pid = None
+_http_adapter = None
+_host_semaphores = {}
+_http_lock = threading.Lock()
+
+
+def _reset_http_pool():
+    global _http_pid, _http_adapter, _host_semaphores
+    if _http_pid != os.getpid():
+        _http_pid = os.getpid()
+        _http_adapter = HTTPAdapter(
+            pool_connections=MAX_HTTP_HOSTS, pool_maxsize=MAX_HOST_REQUESTS)
+        _host_semaphores = {}
+
+
+def mount_http_pool(session):
+    """ Have `session` keep its connections alive in the pool shared by
+    every service client of this process. """
+    with _http_lock:
+        _reset_http_pool()
+        adapter = _http_adapter
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_http_session():
+    """ Return a new requests session whose connections are kept alive in
+    the pool shared by every service client of this process. """
+    return mount_http_pool(requests.Session())
+
+
+def _get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with _http_lock:
+        _reset_http_pool()
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                MAX_HOST_REQUESTS)
+        return _host_semaphores[host]
+
+
+def concurrent_map(func, iterable, max_workers=1):
+    """ Map `func` over `iterable` using up to `max_workers` threads.
+
+    Results are yielded in the order of `iterable`, as soon as they are
+    available.  Services use this to issue their per-repository or
+    per-issue requests concurrently.
+    """
+    if max_workers <= 1:
+        for result in map(func, iterable):
+            yield result
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(func, iterable):
+            yield result
+
+
 def get_service(service_name):
     epoint = iter_entry_points(group='bugwarrior.service', name=service_name)
     try:
@@ -70,6 +176,8 @@ class IssueService(object):
             if option:
                 self.add_tags.append(option)
 
+        self._origin = None
+
         log.info("Working on [%s]", self.target)
 
 
@@ -117,6 +225,15 @@ class IssueService(object):
 
     def get_password(self, key, login='nousername'):
         password = self.config.get(key)
+        if password and password.startswith("@oracle:"):
+            # Resolved up front by `prefetch_passwords`, if at all.
+            prefetched = getattr(self.config, 'passwords', {})
+            option = (self.target, self.config._get_key(key))
+            if option in prefetched:
+                password = prefetched[option]
+                if isinstance(password, BaseException):
+                    raise password
+                return password
         keyring_service = self.get_keyring_service(self.config)
         if not password or password.startswith("@oracle:"):
             password = get_service_password(
@@ -127,19 +244,30 @@ class IssueService(object):
     def get_service_metadata(self):
         return {}
 
+    def get_origin(self):
+        """ Return the origin shared by all issues of this service.
+
+        It is built on first use only, once subclasses are done setting the
+        attributes `get_service_metadata` relies on.  Issues must not
+        modify it.
+        """
+        if self._origin is None:
+            origin = {
+                'annotation_length': self.anno_len,
+                'default_priority': self.default_priority,
+                'description_length': self.desc_len,
+                'templates': self.get_templates(),
+                'target': self.target,
+                'shorten': self.shorten,
+                'inline_links': self.inline_links,
+                'add_tags': self.add_tags,
+            }
+            origin.update(self.get_service_metadata())
+            self._origin = origin
+        return self._origin
+
     def get_issue_for_record(self, record, extra=None):
-        origin = {
-            'annotation_length': self.anno_len,
-            'default_priority': self.default_priority,
-            'description_length': self.desc_len,
-            'templates': self.get_templates(),
-            'target': self.target,
-            'shorten': self.shorten,
-            'inline_links': self.inline_links,
-            'add_tags': self.add_tags,
-        }
-        origin.update(self.get_service_metadata())
-        return self.ISSUE_CLASS(record, origin=origin, extra=extra)
+        return self.ISSUE_CLASS(record, origin=self.get_origin(), extra=extra)
 
     def build_annotations(self, annotations, url):
         final = []
@@ -271,9 +399,17 @@ class Issue(object):
         self._foreign_record = foreign_record
         self._origin = origin if origin else {}
         self._extra = extra if extra else {}
+        self._reset_records()
+
+    def _reset_records(self):
+        self._taskwarrior_record = None
+        self._refined_record = None
+        self._template_context = None
 
     def update_extra(self, extra):
         self._extra.update(extra)
+        # The records are rendered from extra as well.
+        self._reset_records()
 
     def to_taskwarrior(self):
         """ Transform a foreign record into a taskwarrior dictionary."""
@@ -294,23 +430,37 @@ class Issue(object):
     def get_added_tags(self):
         added_tags = []
         for tag in self.origin['add_tags']:
-            tag = Template(tag).render(self.get_template_context())
+            tag = get_template(tag).render(self.get_template_context())
             if tag:
                 added_tags.append(tag)
 
         return added_tags
 
     def get_taskwarrior_record(self, refined=True):
-        if not getattr(self, '_taskwarrior_record', None):
-            self._taskwarrior_record = self.to_taskwarrior()
-        record = copy.deepcopy(self._taskwarrior_record)
-        if refined:
-            record = self.refine_record(record)
-        if not 'tags' in record:
-            record['tags'] = []
-        if refined:
+        return copy.deepcopy(self._get_record(refined))
+
+    def _get_record(self, refined=True):
+        """ Return the taskwarrior record, rendering it on first use only.
+
+        The record is shared by every caller, which only get copies of its
+        values; `get_taskwarrior_record` returns a copy of all of it.
+        """
+        if self._taskwarrior_record is None:
+            record = self.to_taskwarrior()
+            if 'tags' not in record:
+                record['tags'] = []
+            self._taskwarrior_record = record
+        if not refined:
+            return self._taskwarrior_record
+
+        if self._refined_record is None:
+            record = self.refine_record(
+                copy.deepcopy(self._taskwarrior_record))
+            if 'tags' not in record:
+                record['tags'] = []
             record['tags'].extend(self.get_added_tags())
-        return record
+            self._refined_record = record
+        return self._refined_record
 
     def get_priority(self):
         return self.PRIORITY_MAP.get(
@@ -382,26 +532,26 @@ class Issue(object):
         ])
 
     def get_template_context(self):
-        context = (
-            self.get_taskwarrior_record(refined=False).copy()
-        )
-        context.update(self.extra)
-        context.update({
-            'description': self.get_default_description(),
-        })
-        return context
+        if self._template_context is None:
+            context = self._get_record(refined=False).copy()
+            context.update(self.extra)
+            context.update({
+                'description': self.get_default_description(),
+            })
+            self._template_context = context
+        return self._template_context
 
     def refine_record(self, record):
         for field in six.iterkeys(Task.FIELDS):
             if field in self.origin['templates']:
-                template = Template(self.origin['templates'][field])
+                template = get_template(self.origin['templates'][field])
                 record[field] = template.render(self.get_template_context())
             elif hasattr(self, 'get_default_%s' % field):
                 record[field] = getattr(self, 'get_default_%s' % field)()
         return record
 
     def __iter__(self):
-        record = self.get_taskwarrior_record()
+        record = self._get_record()
         for key in six.iterkeys(record):
             yield key
 
@@ -412,13 +562,12 @@ class Issue(object):
         return self.__iter__()
 
     def items(self):
-        record = self.get_taskwarrior_record()
-        return list(six.iteritems(record))
+        return list(self.iteritems())
 
     def iteritems(self):
-        record = self.get_taskwarrior_record()
-        for item in six.iteritems(record):
-            yield item
+        record = self._get_record()
+        for key, value in six.iteritems(record):
+            yield key, _copy_value(value)
 
     def update(self, *args):
         raise AttributeError(
@@ -432,8 +581,10 @@ class Issue(object):
             return default
 
     def __getitem__(self, attribute):
-        record = self.get_taskwarrior_record()
-        return record[attribute]
+        # Values come out as copies, so that callers cannot modify the record
+        # shared by all of them.
+        record = self._get_record()
+        return _copy_value(record[attribute])
 
     def __setitem__(self, attribute, value):
         raise AttributeError(
@@ -460,7 +611,7 @@ class Issue(object):
     def __str__(self):
         return '%s: %s' % (
             self.origin['target'],
-            self.get_taskwarrior_record()['description']
+            self._get_record()['description']
         )
 
     def __repr__(self):
@@ -468,7 +619,24 @@ class Issue(object):
 
 
 class ServiceClient(object):
-    """ Abstract class responsible for making requests to service API's. """
+    """ Abstract class responsible for making requests to service API's.
+
+    Subclasses may set `session` to a session of their own, preferably one
+    obtained from `get_http_session`, to add headers or authentication.
+    """
+    session = None
+
+    def request(self, method, url, **kwargs):
+        """ Send a request through the shared connection pool, waiting while
+        `MAX_HOST_REQUESTS` requests to the same host are in flight. """
+        if self.session is None:
+            self.session = get_http_session()
+        with _get_host_semaphore(url):
+            return self.session.request(method, url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        return self.json_response(self.request('GET', url, **kwargs))
+
     @staticmethod
     def json_response(response):
         # If we didn't get good results, just bail.
@@ -485,20 +653,34 @@ class ServiceClient(object):
             return response.json
 
 
-def _aggregate_issues(conf, main_section, target, queue, service_name):
+def _aggregate_issues(conf, main_section, target, queue, service_name,
+                      keyring_lock=None):
     """ This worker function is separated out from the main
     :func:`aggregate_issues` func only so that we can use multiprocessing
     on it for speed reasons.
+
+    Issues are rendered to their taskwarrior record here and sent in
+    batches, so that neither the issues nor their foreign records have to
+    be pickled over to the parent.  Worker processes look passwords up in
+    the keyring under the given lock, which all of them share.
     """
 
     start = time.time()
+    if keyring_lock is not None:
+        use_keyring_lock(keyring_lock)
 
     try:
         service = get_service(service_name)(conf, main_section, target)
         issue_count = 0
+        batch = []
         for issue in service.issues():
-            queue.put(issue)
+            batch.append(issue.get_taskwarrior_record())
             issue_count += 1
+            if len(batch) >= ISSUE_BATCH_SIZE:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
     except SystemExit as e:
         log.critical(str(e))
         queue.put((SERVICE_FINISHED_ERROR, (target, e)))
@@ -519,16 +701,54 @@ def _aggregate_issues(conf, main_section, target, queue, service_name):
 
 
 def aggregate_issues(conf, main_section, debug):
-    """ Return all issues from every target. """
+    """ Return the taskwarrior records of all issues from every target.
+
+    When ``pipelined`` is enabled in the main section, the completion
+    sentinel of each target is yielded as well, so that the consumer can
+    write out the issues of a target as soon as it is done.  A failing
+    target then no longer aborts the other ones.
+    """
     log.info("Starting to aggregate remote issues.")
 
     # Create and call service objects for every target in the config
     targets = aslist(conf.get(main_section, 'targets'))
 
-    queue = multiprocessing.Queue()
+    pipelined = False
+    if conf.has_option(main_section, 'pipelined'):
+        pipelined = asbool(conf.get(main_section, 'pipelined'))
 
-    log.info("Spawning %i workers." % len(targets))
-    processes = []
+    worker_pool = 'processes'
+    if conf.has_option(main_section, 'worker_pool'):
+        worker_pool = conf.get(main_section, 'worker_pool')
+
+    max_workers = len(targets)
+    if conf.has_option(main_section, 'max_workers'):
+        max_workers = asint(conf.get(main_section, 'max_workers')) or max_workers
+
+    if worker_pool == 'threads':
+        queue = thread_queue.Queue()
+        # Threads share the lock of the module already.
+        keyring_lock = None
+    else:
+        queue = multiprocessing.Queue()
+        keyring_lock = multiprocessing.Lock()
+
+    workers = []
+    pending = list(targets)
+
+    def start_worker():
+        target = pending.pop(0)
+        args = (conf, main_section, target, queue, conf.get(target, 'service'),
+                keyring_lock)
+        if worker_pool == 'threads':
+            worker = threading.Thread(target=_aggregate_issues, args=args)
+            # Do not wait on the workers left behind by a critical error.
+            worker.daemon = True
+        else:
+            worker = multiprocessing.Process(
+                target=_aggregate_issues, args=args)
+        worker.start()
+        workers.append(worker)
 
     if debug:
         for target in targets:
@@ -539,35 +759,32 @@ def aggregate_issues(conf, main_section, debug):
                 queue,
                 conf.get(target, 'service')
             )
+        pending = []
     else:
-        for target in targets:
-            proc = multiprocessing.Process(
-                target=_aggregate_issues,
-                args=(conf, main_section, target, queue, conf.get(target, 'service'))
-            )
-            proc.start()
-            processes.append(proc)
-
-            # Sleep for 1 second here to try and avoid a race condition where
-            # all N workers start up and ask the gpg-agent process for
-            # information at the same time.  This causes gpg-agent to fumble
-            # and tell some of our workers some incomplete things.
-            time.sleep(1)
+        log.info("Spawning %i workers." % min(max_workers, len(targets)))
+        while pending and len(workers) < max_workers:
+            start_worker()
 
     currently_running = len(targets)
     while currently_running > 0:
-        issue = queue.get(True)
-        if isinstance(issue, tuple):
-            completion_type, args = issue
-            if completion_type == SERVICE_FINISHED_ERROR:
+        batch = queue.get(True)
+        if isinstance(batch, tuple):
+            completion_type, args = batch
+            if completion_type == SERVICE_FINISHED_ERROR and not pipelined:
                 target, e = args
                 log.info("Terminating workers")
-                for process in processes:
-                    process.terminate()
+                for worker in workers:
+                    if worker_pool != 'threads':
+                        worker.terminate()
                 raise RuntimeError(
                     "critical error in target '{}'".format(target))
             currently_running -= 1
+            if pending:
+                start_worker()
+            if pipelined:
+                yield batch
             continue
-        yield issue
+        for record in batch:
+            yield record
 
     log.info("Done aggregating remote issues.")
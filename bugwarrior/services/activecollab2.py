@@ -2,7 +2,6 @@ import itertools
 import time
 
 import six
-import requests
 
 from bugwarrior.services import IssueService, Issue, ServiceClient
 from bugwarrior.config import die
@@ -74,7 +73,7 @@ class ActiveCollab2Client(ServiceClient):
             'path_info': uri,
             'format': 'json'}
 
-        return self.json_response(requests.get(url, params=params))
+        return self.get_json(url, params=params)
 
 
 class ActiveCollab2Issue(Issue):
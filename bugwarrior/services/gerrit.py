@@ -6,7 +6,8 @@ import os
 import requests
 
 from bugwarrior.config import die
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, get_http_session)
 
 
 class GerritIssue(Issue):
@@ -73,7 +74,7 @@ class GerritService(IssueService, ServiceClient):
         self.username = self.config.get('username')
         self.password = self.get_password('password', self.username)
         self.ssl_ca_path = self.config.get('ssl_ca_path', None)
-        self.session = requests.session()
+        self.session = get_http_session()
         self.session.headers.update({
             'Accept': 'application/json',
             'Accept-Encoding': 'gzip',
@@ -84,7 +85,8 @@ class GerritService(IssueService, ServiceClient):
 
         # uses digest authentication if supported by the server, fallback to basic
         # gerrithub.io supports only basic
-        response = self.session.head(self.url + '/a/')
+        response = self.request(
+            'HEAD', self.url + '/a/', allow_redirects=False)
         if 'digest' in response.headers.get('www-authenticate', '').lower():
             self.session.auth = requests.auth.HTTPDigestAuth(
                 self.username, self.password)
@@ -116,7 +118,7 @@ class GerritService(IssueService, ServiceClient):
         url = self.url + '/a/changes/' + \
             '?q=is:open+is:reviewer' + \
             '&o=MESSAGES&o=DETAILED_ACCOUNTS'
-        response = self.session.get(url)
+        response = self.request('GET', url)
         response.raise_for_status()
         # The response has some ")]}'" garbage prefixed.
         body = response.text[4:]
@@ -1,28 +1,72 @@
 from builtins import filter
+from builtins import zip
 import re
 import six
+import time
 from urllib.parse import urlparse
 
-import requests
 from six.moves.urllib.parse import quote_plus
-from jinja2 import Template
 
-from bugwarrior.config import asbool, aslist, die
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.config import asbool, asint, aslist, die
+from bugwarrior.data import StampedCache
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, concurrent_map, get_http_session,
+    get_template)
 
 import logging
 log = logging.getLogger(__name__)
 
 
+# Fields fetched for both issues and pull requests by the GraphQL engine,
+# shaped after what the REST API returns.  See `GithubService.from_graphql`.
+GRAPHQL_ISSUE_FIELDS = """
+    title
+    url
+    number
+    body
+    state
+    createdAt
+    updatedAt
+    closedAt
+    repository { nameWithOwner }
+    author { login }
+    milestone { title }
+    assignees(first: 1) { nodes { login } }
+    labels(first: 100) { nodes { name } }
+    comments(last: $comments) {
+        totalCount
+        nodes { author { login } body }
+    }
+"""
+
+GRAPHQL_SEARCH = """
+query($query: String!, $cursor: String, $comments: Int!) {
+    search(query: $query, type: ISSUE, first: 100, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        nodes {
+            __typename
+            ... on Issue { %(fields)s }
+            ... on PullRequest { %(fields)s }
+        }
+    }
+}
+""" % {'fields': GRAPHQL_ISSUE_FIELDS}
+
+
 class GithubClient(ServiceClient):
     def __init__(self, host, auth):
         self.host = host
         self.auth = auth
-        self.session = requests.Session()
+        self.session = get_http_session()
         if 'token' in self.auth:
             authorization = 'token ' + self.auth['token']
             self.session.headers['Authorization'] = authorization
 
+        # Responses from the previous run and from this one, keyed by url,
+        # used to make conditional requests.  `None` disables them.
+        self.cached_responses = None
+        self.fetched_responses = {}
+
     def _api_url(self, path, **context):
         """ Build the full url to the API endpoint """
         if self.host == 'github.com':
@@ -71,6 +115,41 @@ class GithubClient(ServiceClient):
             username=username, repo=repo)
         return self._getter(url)
 
+    def graphql_search(self, query, comment_limit):
+        """ Run an issue/PR query through the GraphQL API.
+
+        Unlike `get_query`, this returns the last `comment_limit` comments
+        of every issue along with it.
+        """
+        if self.host == 'github.com':
+            url = "https://api.github.com/graphql"
+        else:
+            url = "https://{}/api/graphql".format(self.host)
+
+        kwargs = {}
+        if 'basic' in self.auth:
+            kwargs['auth'] = self.auth['basic']
+
+        results = []
+        variables = {'query': query, 'cursor': None, 'comments': comment_limit}
+        while True:
+            response = self.request(
+                'POST', url, json={'query': GRAPHQL_SEARCH, 'variables': variables},
+                **kwargs)
+            json_res = self.json_response(response)
+            if json_res.get('errors'):
+                raise IOError("GraphQL query %r failed: %r" % (
+                    query, json_res['errors']))
+
+            search = json_res['data']['search']
+            results += [node for node in search['nodes'] if node]
+
+            if not search['pageInfo']['hasNextPage']:
+                break
+            variables['cursor'] = search['pageInfo']['endCursor']
+
+        return results
+
     def _getter(self, url, subkey=None):
         """ Pagination utility.  Obnoxious. """
 
@@ -82,24 +161,57 @@ class GithubClient(ServiceClient):
         link = dict(next=url)
 
         while 'next' in link:
-            response = self.session.get(link['next'], **kwargs)
-
-            # Warn about the mis-leading 404 error code.  See:
-            # https://github.com/ralphbean/bugwarrior/issues/374
-            if response.status_code == 404 and 'token' in self.auth:
-                log.warn("A '404' from github may indicate an auth "
-                         "failure. Make sure both that your token is correct "
-                         "and that it has 'public_repo' and not 'public "
-                         "access' rights.")
-
-            json_res = self.json_response(response)
+            url = link['next']
+            headers = {}
+            cached = None
+            if self.cached_responses is not None:
+                cached = self.cached_responses.get(url)
+            if cached:
+                headers['If-None-Match'] = cached['etag']
+
+            response = self.request('GET', url, headers=headers, **kwargs)
+
+            # Back off when hitting github's secondary rate limits.  See:
+            # https://developer.github.com/v3/guides/best-practices-for-integrators/
+            if (response.status_code in (403, 429)
+                    and 'Retry-After' in response.headers):
+                delay = int(response.headers['Retry-After'])
+                log.warn("Rate limited by github, retrying in %is.", delay)
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 304 and cached:
+                # Not modified, which does not count against the rate limit.
+                json_res = cached['body']
+                link_field = cached['link']
+            else:
+                # Warn about the mis-leading 404 error code.  See:
+                # https://github.com/ralphbean/bugwarrior/issues/374
+                if response.status_code == 404 and 'token' in self.auth:
+                    log.warn("A '404' from github may indicate an auth "
+                             "failure. Make sure both that your token is "
+                             "correct and that it has 'public_repo' and not "
+                             "'public access' rights.")
+
+                json_res = self.json_response(response)
+                link_field = response.headers.get('link', None)
+                cached = None
+                if 'ETag' in response.headers:
+                    cached = {
+                        'etag': response.headers['ETag'],
+                        'body': json_res,
+                        'link': link_field,
+                    }
+
+            if cached and self.cached_responses is not None:
+                self.fetched_responses[url] = cached
 
             if subkey is not None:
                 json_res = json_res[subkey]
 
             results += json_res
 
-            link = self._link_field_to_dict(response.headers.get('link', None))
+            link = self._link_field_to_dict(link_field)
 
         return results
 
@@ -237,7 +349,7 @@ class GithubIssue(Issue):
             return tags
 
         context = self.record.copy()
-        label_template = Template(self.origin['label_template'])
+        label_template = get_template(self.origin['label_template'])
 
         for label_dict in self.record.get('labels', []):
             context.update({
@@ -277,6 +389,11 @@ class GithubService(IssueService):
             password = self.get_password('password', self.login)
             auth['basic'] = (self.login, password)
 
+        self.api = self.config.get('api', default='rest')
+        self.graphql_comment_limit = self.config.get(
+            'graphql_comment_limit', default=100, to_type=asint) or 100
+        self.concurrency = self.config.get(
+            'concurrency', default=1, to_type=asint) or 1
         self.client = GithubClient(self.host, auth)
 
         self.exclude_repos = self.config.get('exclude_repos', [], aslist)
@@ -301,6 +418,16 @@ class GithubService(IssueService):
         self.project_owner_prefix = self.config.get(
             'project_owner_prefix', default=False, to_type=asbool
         )
+        self.cache_comments = self.config.get(
+            'cache_comments', default=True, to_type=asbool
+        )
+        self.conditional_requests = self.config.get(
+            'conditional_requests', default=True, to_type=asbool
+        )
+        # Comments keyed by issue url.
+        self.comments_cache = StampedCache()
+        # Comments returned along with the issues by the GraphQL engine.
+        self.inline_comments = {}
 
         self.query = self.config.get(
             'query',
@@ -350,6 +477,77 @@ class GithubService(IssueService):
             issues[issue['url']] = (repos, issue)
         return issues
 
+    def from_graphql(self, node):
+        """ Turn an issue or pull request from the GraphQL API into a record
+        shaped like the ones returned by the REST API. """
+        url = node['url']
+        self.inline_comments[url] = [
+            ((comment['author'] or {}).get('login'), comment['body'])
+            for comment in node['comments']['nodes']
+        ]
+        assignees = node['assignees']['nodes']
+        record = {
+            'title': node['title'],
+            'html_url': url,
+            'url': url,
+            'number': node['number'],
+            'body': node['body'],
+            'state': node['state'].lower(),
+            'created_at': node['createdAt'],
+            'updated_at': node['updatedAt'],
+            'closed_at': node['closedAt'],
+            'user': {'login': (node['author'] or {}).get('login')},
+            'milestone': node['milestone'],
+            'assignee': assignees[0] if assignees else None,
+            'labels': node['labels']['nodes'],
+            'comments': node['comments']['totalCount'],
+        }
+        if node['__typename'] == 'PullRequest':
+            record['pull_request'] = {'html_url': url}
+        return node['repository']['nameWithOwner'], record
+
+    def get_graphql_query(self, query):
+        """ Grab all issues matching a github query, comments included """
+        issues = {}
+        for node in self.client.graphql_search(
+                query, self.graphql_comment_limit):
+            repo, issue = self.from_graphql(node)
+            issues[issue['html_url']] = (repo, issue)
+        return issues
+
+    def get_graphql_issues(self):
+        """ The GraphQL counterpart of the REST queries done by `issues`.
+
+        Owned repositories and directly assigned issues are turned into
+        searches, so that a handful of paginated queries return every issue
+        along with its comments.
+        """
+        issues = {}
+        if self.query:
+            issues.update(self.get_graphql_query(self.query))
+
+        if self.config.get('include_user_repos', True, asbool):
+            if self.include_repos:
+                query = ' '.join(
+                    'repo:%s/%s' % (self.username, repo)
+                    for repo in self.include_repos)
+            else:
+                query = 'user:%s' % self.username
+            repo_issues = self.get_graphql_query(query + ' is:open')
+            issues.update(
+                (url, (repo, issue))
+                for url, (repo, issue) in six.iteritems(repo_issues)
+                if self.filter_repo_name(repo.split('/')[1])
+            )
+
+        if self.config.get('include_user_issues', True, asbool):
+            issues.update(
+                filter(self.filter_issues, self.get_graphql_query(
+                    'assignee:%s is:open' % self.login).items())
+            )
+
+        return issues
+
     @classmethod
     def get_repository_from_issue(cls, issue):
         if 'repo' in issue:
@@ -369,16 +567,32 @@ class GithubService(IssueService):
         user, repo = tag.split('/')
         return self.client.get_comments(user, repo, number)
 
+    def get_comments(self, tag, issue):
+        """ Return the (author, body) pairs of the comments on an issue.
+
+        GraphQL searches return them along with the issue.  Otherwise they
+        are cached, keyed by the issue's ``updated_at`` and ``comments``
+        count, and only fetched through the REST api when either changed.
+        """
+        url = issue['html_url']
+        if url in self.inline_comments:
+            return self.inline_comments[url]
+
+        def fetch_comments():
+            log.debug(" got comments for %s", url)
+            return [
+                (c['user']['login'], c['body'])
+                for c in self._comments(tag, issue['number'])
+            ]
+
+        stamp = [issue.get('updated_at'), issue.get('comments')]
+        return self.comments_cache.get(url, stamp, fetch_comments)
+
     def annotations(self, tag, issue, issue_obj):
         url = issue['html_url']
         annotations = []
         if self.annotation_comments:
-            comments = self._comments(tag, issue['number'])
-            log.debug(" got comments for %s", issue['html_url'])
-            annotations = ((
-                c['user']['login'],
-                c['body'],
-            ) for c in comments)
+            annotations = self.get_comments(tag, issue)
         return self.build_annotations(
             annotations,
             issue_obj.get_processed_url(url)
@@ -426,7 +640,8 @@ class GithubService(IssueService):
                 return True
         return super(GithubService, self).include(issue)
 
-    def issues(self):
+    def get_rest_issues(self):
+        """ Grab all issues through the REST API """
         issues = {}
         if self.query:
             issues.update(self.get_query(self.query))
@@ -452,10 +667,24 @@ class GithubService(IssueService):
                        self.get_directly_assigned_issues().items())
             )
 
+        return issues
+
+    def issues(self):
+        if self.conditional_requests:
+            response_cache = self.config.data.get_cache(
+                'github-responses-' + self.target)
+            self.client.cached_responses = response_cache.load()
+
+        if self.api == 'graphql':
+            issues = self.get_graphql_issues()
+        else:
+            issues = self.get_rest_issues()
+
         log.debug(" Found %i issues.", len(issues))
         issues = list(filter(self.include, issues.values()))
         log.debug(" Pruned down to %i issues.", len(issues))
 
+        issue_objs = []
         for tag, issue in issues:
             # Stuff this value into the upstream dict for:
             # https://github.com/ralphbean/bugwarrior/issues/159
@@ -469,12 +698,31 @@ class GithubService(IssueService):
             extra = {
                 'project': projectName,
                 'type': 'pull_request' if 'pull_request' in issue else 'issue',
-                'annotations': self.annotations(tag, issue, issue_obj),
                 'namespace': self.username,
             }
             issue_obj.update_extra(extra)
+            issue_objs.append((tag, issue, issue_obj))
+
+        # GraphQL searches return the comments along with the issues.
+        cache_comments = self.cache_comments and self.api != 'graphql'
+        if cache_comments:
+            self.comments_cache = StampedCache(
+                self.config.data.get_cache('github-comments-' + self.target))
+            self.comments_cache.load()
+
+        # Fetching comments is one request per issue, so do it concurrently.
+        annotations = concurrent_map(
+            lambda args: self.annotations(*args), issue_objs,
+            self.concurrency)
+        for (_, _, issue_obj), issue_annotations in zip(issue_objs, annotations):
+            issue_obj.update_extra({'annotations': issue_annotations})
             yield issue_obj
 
+        if cache_comments:
+            self.comments_cache.save()
+        if self.conditional_requests:
+            response_cache.save(self.client.fetched_responses)
+
     @classmethod
     def validate_config(cls, service_config, target):
         if 'login' not in service_config:
@@ -486,4 +734,23 @@ class GithubService(IssueService):
         if 'username' not in service_config:
             die("[%s] has no 'github.username'" % target)
 
+        api = service_config.get('api', 'rest')
+        if api not in ('rest', 'graphql'):
+            die("[%s] has an invalid 'github.api', it should be 'rest' or "
+                "'graphql'" % target)
+
+        if api == 'graphql' and 'token' not in service_config:
+            die("[%s] needs a 'github.token' to use the graphql api" % target)
+
+        comment_limit = service_config.get('graphql_comment_limit')
+        if comment_limit:
+            try:
+                # Github refuses to return more than 100 comments at once.
+                valid = 1 <= int(comment_limit) <= 100
+            except ValueError:
+                valid = False
+            if not valid:
+                die("[%s] has an invalid 'github.graphql_comment_limit', it "
+                    "should be between 1 and 100" % target)
+
         super(GithubService, cls).validate_config(service_config, target)
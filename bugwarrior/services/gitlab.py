@@ -3,20 +3,23 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import map
 from builtins import filter
+from builtins import zip
 
 try:
     from urllib import quote, urlencode  # Python 2.X
 except ImportError:
     from urllib.parse import quote, urlencode # Python 3+
 from six.moves.configparser import NoOptionError
+import datetime
 import re
 import requests
 import six
 
-from jinja2 import Template
-
-from bugwarrior.config import asbool, aslist, die
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.config import asbool, asint, aslist, die
+from bugwarrior.data import StampedCache
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, concurrent_map, get_http_session,
+    get_template)
 
 import logging
 log = logging.getLogger(__name__)
@@ -201,7 +204,7 @@ class GitlabIssue(Issue):
             return tags
 
         context = self.record.copy()
-        label_template = Template(self.origin['label_template'])
+        label_template = get_template(self.origin['label_template'])
 
         for label in self.record.get('labels', []):
             context.update({
@@ -226,6 +229,12 @@ class GitlabService(IssueService, ServiceClient):
     ISSUE_CLASS = GitlabIssue
     CONFIG_PREFIX = 'gitlab'
 
+    # The number of items asked for per page.
+    PER_PAGE = 100
+    # Gitlab leaves the total out of collections of more than 10,000 items;
+    # snapshots of those are fetched in full again after this many pulls.
+    SNAPSHOT_PULLS = 10
+
     def __init__(self, *args, **kw):
         super(GitlabService, self).__init__(*args, **kw)
 
@@ -244,10 +253,32 @@ class GitlabService(IssueService, ServiceClient):
             'verify_ssl', default=True, to_type=asbool
         )
 
+        self.concurrency = self.config.get(
+            'concurrency', default=1, to_type=asint) or 1
+        self.session = get_http_session()
+        self.session.headers['PRIVATE-TOKEN'] = token
+        self.session.verify = self.verify_ssl
+        if not self.verify_ssl:
+            requests.packages.urllib3.disable_warnings()
+
         self.membership = self.config.get('membership', False)
 
         self.owned = self.config.get('owned', False)
 
+        self.scope = self.config.get('scope', None)
+
+        self.incremental = self.config.get(
+            'incremental', default=False, to_type=asbool
+        )
+        self.cached_snapshots = {}
+        self.fetched_snapshots = {}
+
+        self.cache_notes = self.config.get(
+            'cache_notes', default=True, to_type=asbool
+        )
+        # Notes keyed by project, issue type and issue number.
+        self.notes_cache = StampedCache()
+
         self.exclude_repos = self.config.get('exclude_repos', [], aslist)
         self.include_repos = self.config.get('include_repos', [], aslist)
         self.exclude_regex = self.config.get('exclude_regex', None)
@@ -340,15 +371,23 @@ class GitlabService(IssueService, ServiceClient):
         tmpl = '{scheme}://{host}/api/v4/projects/%d/%s/%d/notes' % (rid, issue_type, issueid)
         return self._fetch_paged(tmpl)
 
+    def get_notes(self, repo, issue_type, issue):
+        """ Return the (username, body) pairs of the notes on an issue or
+        merge request, fetching them only when its ``updated_at`` or
+        ``user_notes_count`` changed since they were cached.
+        """
+        key = '%d/%s/%d' % (repo['id'], issue_type, issue['iid'])
+        stamp = [issue.get('updated_at'), issue.get('user_notes_count')]
+        return self.notes_cache.get(key, stamp, lambda: [
+            (n['author']['username'], n['body'])
+            for n in self._get_notes(repo['id'], issue_type, issue['iid'])
+        ])
+
     def annotations(self, repo, url, issue_type, issue, issue_obj):
         annotations = []
 
         if self.annotation_comments:
-            notes = self._get_notes(repo['id'], issue_type, issue['iid'])
-            annotations = ((
-                n['author']['username'],
-                n['body']
-            ) for n in notes)
+            annotations = self.get_notes(repo, issue_type, issue)
 
         return self.build_annotations(
             annotations,
@@ -357,49 +396,107 @@ class GitlabService(IssueService, ServiceClient):
 
     def _fetch(self, tmpl, **kwargs):
         url = tmpl.format(scheme=self.scheme, host=self.auth[0])
-        headers = {'PRIVATE-TOKEN': self.auth[1]}
-
-        if not self.verify_ssl:
-            requests.packages.urllib3.disable_warnings()
-        response = requests.get(url, headers=headers, verify=self.verify_ssl, **kwargs)
+        response = self.request('GET', url, **kwargs)
 
         return self.json_response(response)
 
-    def _fetch_paged(self, tmpl):
-        params = {
-            'page': 1,
-            'per_page': 100,
-        }
+    def _fetch_paged(self, tmpl, **params):
+        """ Fetch every page of a collection by following the pagination
+        headers, i.e. the ``Link`` header for keyset pagination and the
+        ``X-Next-Page`` header for offset pagination. """
+        url = tmpl.format(scheme=self.scheme, host=self.auth[0])
+        params['per_page'] = self.PER_PAGE
+        if params.get('pagination') != 'keyset':
+            params['page'] = 1
 
         full = []
-        detect_broken_gitlab_pagination = []
         while True:
-            items = self._fetch(tmpl, params=params)
-            if not items:
+            response = self.request('GET', url, params=params)
+            full += self.json_response(response)
+
+            next_url = response.links.get('next', {}).get('url')
+            next_page = response.headers.get('X-Next-Page')
+            if next_url:
+                # The link carries all of the parameters.
+                url, params = next_url, None
+            elif next_page and params is not None:
+                # Page numbers are only followed as long as links are not.
+                params['page'] = next_page
+            else:
                 break
 
-            # XXX: Some gitlab versions have a bug where pagination doesn't
-            # work and instead return the entire result no matter what. Detect
-            # this by seeing if the results are the same as the last time
-            # around and bail if so. Unfortunately, while it is a GitLab bug,
-            # we have to deal with instances where it exists.
-            if items == detect_broken_gitlab_pagination:
-                break
-            detect_broken_gitlab_pagination = items
+        return full
 
-            full += items
+    def _count(self, tmpl, **params):
+        """ Return the number of items in a collection, as told by the
+        ``X-Total`` header of its first page, or None if it is missing. """
+        url = tmpl.format(scheme=self.scheme, host=self.auth[0])
+        params['per_page'] = 1
+        response = self.request('GET', url, params=params)
+        self.json_response(response)
+        total = response.headers.get('X-Total')
+        return int(total) if total else None
 
-            if len(items) < params['per_page']:
-                break
-            params['page'] += 1
+    def _fetch_open(self, path, **params):
+        """ Fetch the open items of a collection.
 
-        return full
+        In incremental mode, only the items updated since the last pull are
+        fetched and merged into the snapshot of the collection taken then.
+        """
+        tmpl = '{scheme}://{host}/api/v4/' + path
+        if not self.incremental:
+            return self._fetch_paged(tmpl, state='opened', **params)
+
+        key = path
+        if params:
+            key += '?' + urlencode(sorted(params.items()))
+        snapshot = self.cached_snapshots.get(key)
+        # Start the next delta five minutes early, in case the clock of
+        # the gitlab server is behind ours.
+        updated_after = (
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        ).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        # Snapshots which fit into a single page are fetched in full again
+        # rather than along with their changes and number of items.
+        if snapshot is not None and len(snapshot['items']) >= self.PER_PAGE:
+            items = snapshot['items']
+            changes = self._fetch_paged(
+                tmpl, state='all', updated_after=snapshot['updated_after'],
+                **params)
+            changed = set(item['id'] for item in changes)
+            items = [item for item in items if item['id'] not in changed]
+            items += [item for item in changes if item['state'] == 'opened']
+            pulls = snapshot.get('pulls', 0) + 1
+            # Items may leave the collection without being updated, e.g.
+            # when deleted or, in scope mode, assigned to someone else.
+            # Gitlab cannot list their ids alone, but tells how many there
+            # are; start over if that does not add up.
+            total = self._count(tmpl, state='opened', **params)
+            if total is None:
+                stale = pulls >= self.SNAPSHOT_PULLS
+            else:
+                stale = len(items) != total
+            if stale:
+                log.debug("Snapshot of %s is stale.", key)
+                snapshot = None
+        else:
+            snapshot = None
+        if snapshot is None:
+            items = self._fetch_paged(tmpl, state='opened', **params)
+            pulls = 0
+
+        self.fetched_snapshots[key] = {
+            'updated_after': updated_after,
+            'pulls': pulls,
+            'items': items,
+        }
+        return items
 
     def get_repo_issues(self, rid):
-        tmpl = '{scheme}://{host}/api/v4/projects/%d/issues?state=opened' % rid
         issues = {}
         try:
-            repo_issues = self._fetch_paged(tmpl)
+            repo_issues = self._fetch_open('projects/%d/issues' % rid)
         except IOError:
             # Projects may have issues disabled.
             return {}
@@ -408,10 +505,10 @@ class GitlabService(IssueService, ServiceClient):
         return issues
 
     def get_repo_merge_requests(self, rid):
-        tmpl = '{scheme}://{host}/api/v4/projects/%d/merge_requests?state=opened' % rid
         issues = {}
         try:
-            repo_merge_requests = self._fetch_paged(tmpl)
+            repo_merge_requests = self._fetch_open(
+                'projects/%d/merge_requests' % rid)
         except IOError:
             # Projects may have merge requests disabled.
             return {}
@@ -442,6 +539,7 @@ class GitlabService(IssueService, ServiceClient):
     def _get_issue_objs(self, issues, issue_type, repo_map):
         type_plural = issue_type + 's'
 
+        issue_objs = []
         for rid, issue in issues:
             repo = repo_map[rid]
             issue['repo'] = repo['path']
@@ -455,12 +553,42 @@ class GitlabService(IssueService, ServiceClient):
                 'project': repo['path'],
                 'namespace': repo['namespace']['full_path'],
                 'type': issue_type,
-                'annotations': self.annotations(repo, issue_url, type_plural, issue, issue_obj)
             }
             issue_obj.update_extra(extra)
+            issue_objs.append((repo, issue_url, type_plural, issue, issue_obj))
+
+        # Notes are fetched with one request per issue, so do it concurrently.
+        annotations = concurrent_map(
+            lambda args: self.annotations(*args), issue_objs,
+            self.concurrency)
+        for args, issue_annotations in zip(issue_objs, annotations):
+            issue_obj = args[-1]
+            issue_obj.update_extra({'annotations': issue_annotations})
             yield issue_obj
 
-    def issues(self):
+    def get_scoped_items(self, item_type):
+        items = {}
+        for item in self._fetch_open(item_type, scope=self.scope):
+            items[item['id']] = (item['project_id'], item)
+        return items
+
+    def resolve_repos(self, items, repo_map):
+        """ Fetch the projects referenced by items which are not yet in
+        repo_map, then drop the items of projects rejected by filter_repos.
+        Rejected projects are kept in repo_map as None. """
+        tmpl = '{scheme}://{host}/api/v4/projects/%d?simple=true'
+        rids = sorted(set(rid for rid, _ in items.values()) - set(repo_map))
+        repos = concurrent_map(
+            lambda rid: self._fetch(tmpl % rid), rids, self.concurrency)
+        for rid, repo in zip(rids, repos):
+            repo_map[rid] = repo if self.filter_repos(repo) else None
+
+        return dict(
+            (key, (rid, item)) for key, (rid, item) in items.items()
+            if repo_map[rid] is not None
+        )
+
+    def get_repo_map(self):
         tmpl = '{scheme}://{host}/api/v4/projects'
 
         all_repos = []
@@ -474,23 +602,46 @@ class GitlabService(IssueService, ServiceClient):
                 all_repos.append(item)
 
         else:
-            querystring = { 'simple': True }
+            querystring = {
+                'simple': True,
+                'pagination': 'keyset',
+                'order_by': 'id',
+                'sort': 'asc',
+            }
             if self.membership:
                 querystring['membership'] = True
             if self.owned:
                 querystring['owned'] = True
-            all_repos = self._fetch_paged(tmpl + '?' + urlencode(querystring))
+            all_repos = self._fetch_paged(tmpl, **querystring)
 
         repos = list(filter(self.filter_repos, all_repos))
 
         repo_map = {}
-        issues = {}
         for repo in repos:
-            rid = repo['id']
-            repo_map[rid] = repo
-            issues.update(
-                self.get_repo_issues(rid)
-            )
+            repo_map[repo['id']] = repo
+        return repo_map
+
+    def issues(self):
+        if self.incremental:
+            snapshot_cache = self.config.data.get_cache(
+                'gitlab-snapshots-' + self.target)
+            self.cached_snapshots = snapshot_cache.load()
+        if self.cache_notes:
+            self.notes_cache = StampedCache(
+                self.config.data.get_cache('gitlab-notes-' + self.target))
+            self.notes_cache.load()
+
+        if self.scope:
+            # Only the projects referenced by the results get fetched.
+            repo_map = {}
+            issues = self.resolve_repos(
+                self.get_scoped_items('issues'), repo_map)
+        else:
+            repo_map = self.get_repo_map()
+            issues = {}
+            for repo_issues in concurrent_map(
+                    self.get_repo_issues, list(repo_map), self.concurrency):
+                issues.update(repo_issues)
         log.debug(" Found %i issues.", len(issues))
         issues = list(filter(self.include, issues.values()))
         log.debug(" Pruned down to %i issues.", len(issues))
@@ -499,12 +650,15 @@ class GitlabService(IssueService, ServiceClient):
             yield issue
 
         if not self.filter_merge_requests:
-            merge_requests = {}
-            for repo in repos:
-                rid = repo['id']
-                merge_requests.update(
-                    self.get_repo_merge_requests(rid)
-                )
+            if self.scope:
+                merge_requests = self.resolve_repos(
+                    self.get_scoped_items('merge_requests'), repo_map)
+            else:
+                merge_requests = {}
+                for repo_merge_requests in concurrent_map(
+                        self.get_repo_merge_requests,
+                        list(repo_map), self.concurrency):
+                    merge_requests.update(repo_merge_requests)
             log.debug(" Found %i merge requests.", len(merge_requests))
             merge_requests = list(filter(self.include, merge_requests.values()))
             log.debug(" Pruned down to %i merge requests.", len(merge_requests))
@@ -518,6 +672,14 @@ class GitlabService(IssueService, ServiceClient):
             todos = self.get_todos()
             log.debug(" Found %i todo items.", len(todos))
             if not self.include_all_todos:
+                if self.scope:
+                    # Only the projects of the scoped items were fetched so
+                    # far; fetch and filter those of the todos as well.
+                    self.resolve_repos(dict(
+                        (todo['id'], (project['id'], todo))
+                        for project, todo in todos if project is not None
+                    ), repo_map)
+                repos = [repo for repo in repo_map.values() if repo]
                 todos = list(filter(self.include_todo(repos), todos))
             log.debug(" Pruned down to %i todos.", len(todos))
 
@@ -545,6 +707,12 @@ class GitlabService(IssueService, ServiceClient):
                 todo_obj.update_extra(extra)
                 yield todo_obj
 
+        if self.incremental:
+            # Snapshots of collections no longer pulled are dropped.
+            snapshot_cache.save(self.fetched_snapshots)
+        if self.cache_notes:
+            self.notes_cache.save()
+
     @classmethod
     def validate_config(cls, service_config, target):
         if 'host' not in service_config:
@@ -556,4 +724,9 @@ class GitlabService(IssueService, ServiceClient):
         if 'token' not in service_config:
             die("[%s] has no 'gitlab.token'" % target)
 
+        scope = service_config.get('scope', None)
+        if scope not in (None, 'created_by_me', 'assigned_to_me', 'all'):
+            die("[%s] has an invalid 'gitlab.scope' %r, expected one of "
+                "created_by_me, assigned_to_me or all" % (target, scope))
+
         super(GitlabService, cls).validate_config(service_config, target)
@@ -1,15 +1,19 @@
 from __future__ import absolute_import
 from builtins import str
 
+import math
+import re
+import time
 
 import six
-from jinja2 import Template
 from jira.client import JIRA as BaseJIRA
 from requests.cookies import RequestsCookieJar
 from dateutil.tz.tz import tzutc
+from jinja2 import Environment, nodes
 
-from bugwarrior.config import asbool, die
-from bugwarrior.services import IssueService, Issue
+from bugwarrior.config import asbool, asint, die
+from bugwarrior.services import (
+    IssueService, Issue, concurrent_map, get_template, mount_http_pool)
 
 import logging
 log = logging.getLogger(__name__)
@@ -30,6 +34,21 @@ class ObliviousCookieJar(RequestsCookieJar):
 
 
 class JIRA(BaseJIRA):
+    def __init__(self, *args, **kwargs):
+        # Server responses which hardly ever change, kept across pulls.
+        self.metadata = kwargs.pop('metadata', None) or {}
+        super(JIRA, self).__init__(*args, **kwargs)
+
+    def server_info(self):
+        if 'server_info' not in self.metadata:
+            self.metadata['server_info'] = super(JIRA, self).server_info()
+        return self.metadata['server_info']
+
+    def fields(self):
+        if 'fields' not in self.metadata:
+            self.metadata['fields'] = super(JIRA, self).fields()
+        return self.metadata['fields']
+
     def _create_http_basic_session(self, *args, **kwargs):
         super(JIRA, self)._create_http_basic_session(*args, **kwargs)
 
@@ -55,6 +74,32 @@ def _parse_sprint_string(sprint):
     return dict(zip(fields[::2], fields[1::2]))
 
 
+def _get_template_fields(source):
+    """ Return the names of the issue fields a template refers to.
+
+    Templates rendered against the jira record refer to its fields as
+    `{{fields.customfield_10001}}` or `{{fields['customfield_10001']}}`.
+    None is returned if the template uses `fields` in any other way.
+    """
+    ast = Environment().parse(source)
+    references = sum(
+        1 for node in ast.find_all(nodes.Name) if node.name == 'fields')
+    names = set()
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if not isinstance(node.node, nodes.Name) or node.node.name != 'fields':
+            continue
+        references -= 1
+        if isinstance(node, nodes.Getattr):
+            names.add(node.attr)
+        elif isinstance(node.arg, nodes.Const):
+            names.add(node.arg.value)
+        else:
+            return None
+    if references:
+        return None
+    return names
+
+
 class JiraIssue(Issue):
     ISSUE_TYPE = 'jiraissuetype'
     SUMMARY = 'jirasummary'
@@ -165,7 +210,7 @@ class JiraIssue(Issue):
             return tags
 
         context = self.record.copy()
-        label_template = Template(self.origin['label_template'])
+        label_template = get_template(self.origin['label_template'])
 
         sprints = self.__get_sprints()
         for sprint in sprints:
@@ -192,7 +237,7 @@ class JiraIssue(Issue):
             return tags
 
         context = self.record.copy()
-        label_template = Template(self.origin['label_template'])
+        label_template = get_template(self.origin['label_template'])
 
         for label in self.record.get('fields', {}).get('labels', []):
             context.update({'label': label})
@@ -260,6 +305,12 @@ class JiraService(IssueService):
     ISSUE_CLASS = JiraIssue
     CONFIG_PREFIX = 'jira'
 
+    # The fields JiraIssue reads; the others are not requested.
+    SEARCH_FIELDS = [
+        'summary', 'timeestimate', 'priority', 'status', 'issuetype',
+        'created', 'duedate', 'fixVersions', 'labels', 'description',
+    ]
+
     def __init__(self, *args, **kw):
         super(JiraService, self).__init__(*args, **kw)
         self.username = self.config.get('username')
@@ -269,6 +320,12 @@ class JiraService(IssueService):
         default_query = 'assignee=' + self.username + \
             ' AND resolution is null'
         self.query = self.config.get('query', default_query)
+        self.metadata_ttl = self.config.get(
+            'metadata_ttl', default=86400, to_type=asint)
+        if self.metadata_ttl is None:
+            self.metadata_ttl = 86400
+        # The metadata as last saved to the cache.
+        self.saved_metadata = self.get_cached_metadata()
         if password == '@kerberos':
             auth = dict(kerberos=True)
         else:
@@ -279,8 +336,17 @@ class JiraService(IssueService):
                 'rest_api_version': 'latest',
                 'verify': self.config.get('verify_ssl', default=True, to_type=asbool),
             },
+            metadata=dict(self.saved_metadata),
             **auth
         )
+        # Search pages may be fetched concurrently.
+        mount_http_pool(self.jira._session)
+        self.concurrency = self.config.get(
+            'concurrency', default=1, to_type=asint) or 1
+        self.page_size = self.config.get(
+            'page_size', default=100, to_type=asint) or 100
+        self.incremental = self.config.get(
+            'incremental', default=False, to_type=asbool)
         self.import_labels_as_tags = self.config.get(
             'import_labels_as_tags', default=False, to_type=asbool
         )
@@ -290,6 +356,9 @@ class JiraService(IssueService):
         self.label_template = self.config.get(
             'label_template', default='{{label}}', to_type=six.text_type
         )
+        self.comment_limit = self.config.get(
+            'comment_limit', default=None, to_type=asint
+        )
 
         self.sprint_field_names = []
         if self.import_sprints_as_tags:
@@ -302,6 +371,62 @@ class JiraService(IssueService):
                 log.info("Found %i distinct sprint fields." % len(field_names))
                 self.sprint_field_names = [field['id'] for field in field_names]
 
+        self.cache_metadata()
+
+        self.search_fields = self.get_search_fields()
+
+    def get_metadata_cache(self):
+        return self.config.data.get_cache('jira-metadata-' + self.target)
+
+    def get_cached_metadata(self):
+        """ Return the server metadata cached by an earlier pull.
+
+        Nothing is returned if the cache is disabled, stale, or for another
+        server, or if `--refresh-metadata` was given.
+        """
+        if self.metadata_ttl <= 0 or getattr(
+                self.config, 'refresh_metadata', False):
+            return {}
+        cached = self.get_metadata_cache().load()
+        if (cached.get('base_uri') != self.url or
+                time.time() - cached.get('time', 0) > self.metadata_ttl):
+            return {}
+        return cached['metadata']
+
+    def cache_metadata(self):
+        """ Save the metadata the client fetched since it was last saved.
+
+        Besides start-up, the client fetches the fields on its first search.
+        """
+        metadata = self.jira.metadata
+        if self.metadata_ttl > 0 and metadata != self.saved_metadata:
+            self.saved_metadata = dict(metadata)
+            self.get_metadata_cache().save({
+                'base_uri': self.url,
+                'time': time.time(),
+                'metadata': self.saved_metadata,
+            })
+
+    def get_search_fields(self):
+        """ Return the comma-separated fields to request from searches. """
+        fields = list(self.SEARCH_FIELDS)
+        if self.annotation_comments:
+            fields.append('comment')
+        fields.extend(self.sprint_field_names)
+
+        # The label template is the only one rendered against the jira
+        # record, rather than the taskwarrior one.
+        if self.import_labels_as_tags or self.import_sprints_as_tags:
+            names = _get_template_fields(self.label_template)
+            if names is None:
+                log.debug(
+                    "Requesting all fields for %s.", self.label_template)
+                fields.append('*navigable')
+            else:
+                fields.extend(sorted(names - set(fields)))
+
+        return ','.join(fields)
+
     @staticmethod
     def get_keyring_service(service_config):
         username = service_config.get('username')
@@ -323,33 +448,189 @@ class JiraService(IssueService):
             if option not in service_config:
                 die("[%s] has no 'jira.%s'" % (target, option))
 
+        metadata_ttl = service_config.get('metadata_ttl')
+        if metadata_ttl:
+            try:
+                valid = int(metadata_ttl) >= 0
+            except ValueError:
+                valid = False
+            if not valid:
+                die("[%s] has an invalid 'jira.metadata_ttl', it should be "
+                    "a number of seconds" % target)
+
         IssueService.validate_config(service_config, target)
 
-    def annotations(self, issue, issue_obj):
-        comments = self.jira.comments(issue.key) or []
+    def get_comments(self, record):
+        """ Return the (author name, body) pairs of an issue's comments.
+
+        The search results carry them in the ``comment`` field, which jira
+        truncates; they are only fetched separately when its ``total`` is
+        more than the comments it holds.
+        """
+        comment_field = record['fields'].get('comment')
+        if (comment_field is None or
+                comment_field['total'] > len(comment_field['comments'])):
+            comments = [
+                (comment.author.name, comment.body)
+                for comment in self.jira.comments(record['key']) or []
+            ]
+        else:
+            comments = [
+                (comment['author']['name'], comment['body'])
+                for comment in comment_field['comments']
+            ]
+
+        if self.comment_limit:
+            comments = comments[-self.comment_limit:]
+        return comments
+
+    def annotations(self, record, issue_obj):
+        # Comments are not requested when they would be left out anyway.
+        comments = self.get_comments(record) if self.annotation_comments else []
         return self.build_annotations(
-            ((
-                comment.author.name,
-                comment.body
-            ) for comment in comments),
+            comments,
             issue_obj.get_processed_url(issue_obj.get_url())
         )
 
-    def issues(self):
-        cases = self.jira.search_issues(self.query, maxResults=-1)
+    def search(self, query, fields):
+        """ Yield the raw records of the issues matching a query.
+
+        On jira server, the first page tells how many issues there are; the
+        remaining pages are then fetched `concurrency` at a time.  Records
+        are yielded in the order of the search results either way.
+        """
+        # Jira cloud only pages through searches with a token handed out
+        # along with each page, so its pages are fetched one after another.
+        if getattr(self.jira, '_is_cloud', False):
+            for record in self.search_cloud(query, fields):
+                yield record
+            return
+
+        def fetch_page(start, size):
+            return self.jira.search_issues(
+                query, startAt=start, maxResults=size,
+                fields=fields, json_result=True)
+
+        page = fetch_page(0, self.page_size)
+        for record in page['issues']:
+            yield record
+
+        # The server may return fewer issues per page than were asked for.
+        size = len(page['issues'])
+        if not size:
+            return
+        if 'total' not in page:
+            start = size
+            while len(page['issues']) == size:
+                page = fetch_page(start, size)
+                for record in page['issues']:
+                    yield record
+                start += size
+            return
+        pages = concurrent_map(
+            lambda start: fetch_page(start, size),
+            range(size, page['total'], size),
+            self.concurrency)
+        for page in pages:
+            for record in page['issues']:
+                yield record
+
+    def search_cloud(self, query, fields):
+        """ Yield the raw records of the issues matching a query on jira
+        cloud, following the token of each page to the next one.
+        """
+        token = None
+        while True:
+            page = self.jira.enhanced_search_issues(
+                query, nextPageToken=token, maxResults=self.page_size,
+                fields=fields, json_result=True)
+            for record in page['issues']:
+                yield record
+            token = page.get('nextPageToken')
+            if page.get('isLast', True) or not token:
+                return
+
+    def search_incremental(self, snapshot):
+        """ Return the records of the issues matching the query, fetching
+        only those updated since the snapshot of an earlier pull was taken.
+
+        A search for the keys alone then tells which issues left the results
+        since, and which entered them without being updated.
+        """
+        # The conditions are narrowed down below, so a trailing ORDER BY
+        # clause has to stay at the very end of the query.  A query may also
+        # be an ORDER BY clause alone.
+        conditions, order_by = re.match(
+            r'(?is)^(.*?)(?:(?:^|\s+)(ORDER\s+BY\s+.*))?$',
+            self.query).groups()
+
+        def narrow(condition):
+            if conditions:
+                condition = '(%s) AND %s' % (conditions, condition)
+            if order_by:
+                condition += ' ' + order_by
+            return condition
+
+        # JQL dates are in the timezone of the jira user, so ask for the
+        # issues updated in the last minutes instead, plus a margin in case
+        # the jira server's clock runs behind ours.
+        minutes = int(math.ceil((time.time() - snapshot['time']) / 60)) + 5
+        query = narrow('updated >= "-%im"' % minutes)
+        records = dict(
+            (record['key'], record)
+            for record in self.search(query, self.search_fields))
+        log.debug(" Found %i updated issues.", len(records))
+
+        keys = [record['key'] for record in self.search(self.query, 'key')]
+        for key in keys:
+            if key not in records and key in snapshot['records']:
+                records[key] = snapshot['records'][key]
+
+        missing = [key for key in keys if key not in records]
+        if missing:
+            query = narrow('key in (%s)' % ', '.join(missing))
+            for record in self.search(query, self.search_fields):
+                records[record['key']] = record
+
+        return [records[key] for key in keys if key in records]
 
+    def issues(self):
         jira_version = 5
         if self.config.has_option(self.target, 'jira.version'):
             jira_version = self.config.getint(self.target, 'jira.version')
 
-        for case in cases:
-            issue = self.get_issue_for_record(case.raw)
+        if self.incremental:
+            snapshot_cache = self.config.data.get_cache(
+                'jira-snapshots-' + self.target)
+            snapshot = snapshot_cache.load()
+            started = time.time()
+            # Records are only reused if they hold the same fields.
+            if (snapshot.get('query') == self.query and
+                    snapshot.get('fields') == self.search_fields):
+                records = self.search_incremental(snapshot)
+            else:
+                records = list(self.search(self.query, self.search_fields))
+        else:
+            records = self.search(self.query, self.search_fields)
+
+        for record in records:
+            issue = self.get_issue_for_record(record)
             extra = {
                 'jira_version': jira_version,
             }
             if jira_version > 4:
                 extra.update({
-                    'annotations': self.annotations(case, issue)
+                    'annotations': self.annotations(record, issue)
                 })
             issue.update_extra(extra)
             yield issue
+
+        self.cache_metadata()
+        if self.incremental:
+            snapshot_cache.save({
+                'query': self.query,
+                'fields': self.search_fields,
+                'time': started,
+                'records': dict(
+                    (record['key'], record) for record in records),
+            })
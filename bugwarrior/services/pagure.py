@@ -6,10 +6,8 @@ import pytz
 
 import requests
 
-from jinja2 import Template
-
 from bugwarrior.config import asbool, aslist, die
-from bugwarrior.services import IssueService, Issue
+from bugwarrior.services import IssueService, Issue, get_template
 
 import logging
 log = logging.getLogger(__name__)
@@ -82,7 +80,7 @@ class PagureIssue(Issue):
             return tags
 
         context = self.record.copy()
-        tag_template = Template(self.origin['tag_template'])
+        tag_template = get_template(self.origin['tag_template'])
 
         for tagname in self.record.get('tags', []):
             context.update({'label': self._normalize_label_to_tag(tagname) })
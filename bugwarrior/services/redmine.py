@@ -1,5 +1,4 @@
 import six
-import requests
 import re
 
 from bugwarrior.config import die, asbool
@@ -40,7 +39,7 @@ class RedMineClient(ServiceClient):
 
         kwargs['verify'] = self.verify_ssl
 
-        return self.json_response(requests.get(url, **kwargs))
+        return self.get_json(url, **kwargs)
 
 
 class RedMineIssue(Issue):
@@ -1,10 +1,10 @@
 from __future__ import absolute_import
 
-import requests
 import six
 from bugwarrior.db import CACHE_REGION as cache
 from bugwarrior.config import die
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, get_http_session)
 
 import logging
 log = logging.getLogger(__name__)
@@ -67,7 +67,7 @@ class TaigaService(IssueService, ServiceClient):
         self.label_template = self.config.get(
             'label_template', default='{{label}}', to_type=six.text_type
         )
-        self.session = requests.session()
+        self.session = get_http_session()
         self.session.headers.update({
             'Accept': 'application/json',
             'Authorization': 'Bearer %s' % self.auth_token,
@@ -95,8 +95,8 @@ class TaigaService(IssueService, ServiceClient):
     def _issues(self, userid, task_type, task_type_plural, task_type_short):
         log.debug('Getting %s' % task_type_plural)
 
-        response = self.session.get(
-            self.url + '/api/v1/' + task_type_plural,
+        response = self.request(
+            'GET', self.url + '/api/v1/' + task_type_plural,
             params={'assigned_to': userid, 'status__is_closed': "false"})
         tasks = response.json()
 
@@ -111,7 +111,7 @@ class TaigaService(IssueService, ServiceClient):
 
     def issues(self):
         url = self.url + '/api/v1/users/me'
-        me = self.session.get(url)
+        me = self.request('GET', url)
         data = me.json()
 
         # Check for errors and bail if we failed.
@@ -131,14 +131,14 @@ class TaigaService(IssueService, ServiceClient):
     @cache.cache_on_arguments()
     def get_project(self, project_id):
         url = '%s/api/v1/projects/%i' % (self.url, project_id)
-        return self.json_response(self.session.get(url))
+        return self.get_json(url)
 
     def build_url(self, task, project, task_type):
         return '%s/project/%s/%s/%i' % (self.url, project['slug'], task_type, task['ref'])
 
     def annotations(self, task, project, task_type, task_type_short):
         url = '%s/api/v1/history/%s/%i' % (self.url, task_type, task['id'])
-        response = self.session.get(url)
+        response = self.request('GET', url)
         history = response.json()
         return self.build_annotations(
             ((
@@ -3,7 +3,6 @@ import re
 import six
 from urllib.parse import urlparse
 
-import requests
 from six.moves.urllib.parse import quote_plus
 from jinja2 import Template
 
@@ -20,12 +19,12 @@ class TeamworkClient(ServiceClient):
         self.token = token
 
     def authenticate(self):
-        response = requests.get(self.host + "/authenticate.json", auth=(self.token, ""))
-        return self.json_response(response)
+        return self.get_json(
+            self.host + "/authenticate.json", auth=(self.token, ""))
 
     def call_api(self, method, endpoint, data=None):
-        response = requests.get(self.host + endpoint, auth=(self.token, ""), params=data)
-        return self.json_response(response)
+        return self.get_json(
+            self.host + endpoint, auth=(self.token, ""), params=data)
 
 class TeamworkIssue(Issue):
     URL = 'teamwork_url'
@@ -10,10 +10,8 @@ from future import standard_library
 standard_library.install_aliases()
 from six.moves.configparser import NoOptionError
 
-from jinja2 import Template
-import requests
-
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, get_template)
 from bugwarrior.config import die, asbool, aslist
 
 DEFAULT_LABEL_TEMPLATE = "{{label|replace(' ', '_')}}"
@@ -50,7 +48,7 @@ class TrelloIssue(Issue):
         )
 
     def get_tags(self, twdict):
-        tmpl = Template(
+        tmpl = get_template(
             self.origin.get('label_template', DEFAULT_LABEL_TEMPLATE))
         return [tmpl.render(twdict, label=label['name'])
                 for label in self.record['labels']]
@@ -196,4 +194,4 @@ class TrelloService(IssueService, ServiceClient):
         params['key'] = self.config.get('api_key'),
         params['token'] = self.config.get('token'),
         url = "https://api.trello.com" + url
-        return self.json_response(requests.get(url, params=params))
+        return self.get_json(url, params=params)
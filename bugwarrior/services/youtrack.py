@@ -3,10 +3,10 @@ import re
 import six
 
 import requests
-from jinja2 import Template
 
 from bugwarrior.config import asbool, die
-from bugwarrior.services import IssueService, Issue, ServiceClient
+from bugwarrior.services import (
+    IssueService, Issue, ServiceClient, get_http_session, get_template)
 
 import logging
 
@@ -99,7 +99,7 @@ class YoutrackIssue(Issue):
             return tags
 
         context = self.record.copy()
-        tag_template = Template(self.origin['tag_template'])
+        tag_template = get_template(self.origin['tag_template'])
 
         for tag_dict in self.record.get('tag', []):
             context.update({
@@ -130,7 +130,7 @@ class YoutrackService(IssueService, ServiceClient):
         self.base_url = '%s://%s:%s' % (self.scheme, self.host, self.port)
         self.rest_url = self.base_url + '/rest'
 
-        self.session = requests.Session()
+        self.session = get_http_session()
         self.session.headers['Accept'] = 'application/json'
         self.verify_ssl = self.config.get('verify_ssl', default=True, to_type=asbool)
         if not self.verify_ssl:
@@ -154,7 +154,7 @@ class YoutrackService(IssueService, ServiceClient):
 
     def _login(self, login, password):
         params = {'login': login, 'password': password}
-        resp = self.session.post(self.rest_url + "/user/login", params)
+        resp = self.request('POST', self.rest_url + "/user/login", data=params)
         if resp.status_code != 200:
             raise RuntimeError("YouTrack responded with %s" % resp)
         self.session.headers['Cookie'] = resp.headers['set-cookie']
@@ -182,7 +182,7 @@ class YoutrackService(IssueService, ServiceClient):
 
     def issues(self):
         params = {'filter': self.query, 'max': self.query_limit}
-        resp = self.session.get(self.rest_url + '/issue', params=params)
+        resp = self.request('GET', self.rest_url + '/issue', params=params)
         issues = self.json_response(resp)['issue']
         log.debug(" Found %i total.", len(issues))
 
@@ -38,6 +38,7 @@ setup(name='bugwarrior',
           "lockfile>=0.9.1",
           "click",
           "future",
+          "futures; python_version < '3'",
       ],
       extras_require=dict(
           keyring=["keyring"],
@@ -2,10 +2,14 @@
 from __future__ import unicode_literals
 
 import os
+import time
 from six.moves import configparser
 from unittest import TestCase
 
+import mock
+
 import bugwarrior.config as config
+from bugwarrior.services.github import GithubService
 
 from .base import ConfigTest
 
@@ -118,6 +122,144 @@ class TestOracleEval(TestCase):
         self.assertEqual(config.oracle_eval("echo fööbår"), "fööbår")
 
 
+class TestPrefetchPasswords(TestCase):
+    def setUp(self):
+        self.conf = config.BugwarriorConfigParser()
+        self.conf.add_section('general')
+        self.conf.add_section('mygithub')
+        self.conf.set('mygithub', 'service', 'github')
+        self.conf.set('mygithub', 'github.login', 'tintin')
+        self.conf.set('mygithub', 'github.username', 'milou')
+        self.conf.set(
+            'mygithub', 'github.token', '@oracle:eval:echo prefetched')
+
+        patcher = mock.patch(
+            'bugwarrior.config.get_service', return_value=GithubService)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefetch(self):
+        config.prefetch_passwords(self.conf, 'general', ['mygithub'])
+
+        self.assertEqual(
+            self.conf.passwords,
+            {('mygithub', 'github.token'): 'prefetched'})
+        with mock.patch('bugwarrior.config.oracle_eval') as oracle_eval:
+            service = GithubService(self.conf, 'general', 'mygithub')
+        self.assertFalse(oracle_eval.called)
+        self.assertEqual(
+            service.client.session.headers['Authorization'],
+            'token prefetched')
+
+    def test_failing_oracle(self):
+        self.conf.add_section('badgithub')
+        self.conf.set('badgithub', 'service', 'github')
+        self.conf.set('badgithub', 'github.login', 'tintin')
+        self.conf.set('badgithub', 'github.username', 'milou')
+        self.conf.set('badgithub', 'github.token', '@oracle:eval:false')
+
+        config.prefetch_passwords(
+            self.conf, 'general', ['badgithub', 'mygithub'])
+
+        # Only the target of the failing oracle fails.
+        with self.assertRaises(SystemExit):
+            GithubService(self.conf, 'general', 'badgithub')
+        service = GithubService(self.conf, 'general', 'mygithub')
+        self.assertEqual(
+            service.client.session.headers['Authorization'],
+            'token prefetched')
+
+    def test_cache_ttl(self):
+        stored = {}
+        keyring = mock.Mock()
+        keyring.get_password.side_effect = (
+            lambda service, username: stored.get((service, username)))
+        keyring.set_password.side_effect = (
+            lambda service, username, password:
+                stored.__setitem__((service, username), password))
+        patcher = mock.patch(
+            'bugwarrior.config.get_keyring', return_value=keyring)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conf.set('general', 'password_cache_ttl', '60')
+
+        config.prefetch_passwords(self.conf, 'general', ['mygithub'])
+        with mock.patch('bugwarrior.config.oracle_eval') as oracle_eval:
+            config.prefetch_passwords(self.conf, 'general', ['mygithub'])
+        self.assertFalse(oracle_eval.called)
+        self.assertEqual(
+            self.conf.passwords,
+            {('mygithub', 'github.token'): 'prefetched'})
+        self.assertEqual(
+            list(stored), [(config.ORACLE_CACHE_KEYRING_SERVICE,
+                            '@oracle:eval:echo prefetched')])
+
+        # Expired results are evaluated again.
+        with mock.patch('time.time', return_value=time.time() + 61):
+            with mock.patch('bugwarrior.config.oracle_eval') as oracle_eval:
+                oracle_eval.return_value = 'evaluated'
+                config.prefetch_passwords(self.conf, 'general', ['mygithub'])
+        self.assertEqual(
+            self.conf.passwords,
+            {('mygithub', 'github.token'): 'evaluated'})
+
+    def test_no_cache_without_ttl(self):
+        with mock.patch('bugwarrior.config.get_keyring') as get_keyring:
+            config.prefetch_passwords(self.conf, 'general', ['mygithub'])
+        self.assertFalse(get_keyring.called)
+
+
+class TestKeyring(TestCase):
+    def test_lookups_serialized(self):
+        def get_password(service, username):
+            # Workers looking up passwords at the same time would block.
+            self.assertFalse(config._keyring_lock.acquire(False))
+            return 'secret'
+
+        keyring = mock.Mock()
+        keyring.get_password.side_effect = get_password
+        with mock.patch('bugwarrior.config.get_keyring', return_value=keyring):
+            self.assertEqual(
+                config.get_service_password(
+                    'github://tintin@github.com/milou', 'tintin'),
+                'secret')
+        self.assertTrue(config._keyring_lock.acquire(False))
+        config._keyring_lock.release()
+
+
+class TestValidateConfig(TestCase):
+    def setUp(self):
+        self.config = config.BugwarriorConfigParser()
+        self.config.add_section('general')
+        self.config.set('general', 'targets', 'mygithub')
+        self.config.set('general', 'log.level', 'DEBUG')
+        self.config.set('general', 'log.file', '')
+        self.config.add_section('mygithub')
+        self.config.set('mygithub', 'service', 'github')
+        self.config.set('mygithub', 'github.login', 'tintin')
+        self.config.set('mygithub', 'github.username', 'milou')
+        self.config.set('mygithub', 'github.password', 'secret')
+
+        patcher = mock.patch(
+            'bugwarrior.config.get_service', return_value=GithubService)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_max_workers(self):
+        self.config.set('general', 'max_workers', '2')
+        config.validate_config(self.config, 'general')
+
+    def test_max_workers_negative(self):
+        self.config.set('general', 'max_workers', '-1')
+        with self.assertRaises(SystemExit):
+            config.validate_config(self.config, 'general')
+
+    def test_max_workers_not_an_integer(self):
+        self.config.set('general', 'max_workers', 'many')
+        with self.assertRaises(SystemExit):
+            config.validate_config(self.config, 'general')
+
+
 class TestBugwarriorConfigParser(TestCase):
     def setUp(self):
         self.config = config.BugwarriorConfigParser()
@@ -39,3 +39,67 @@ class TestData(ConfigTest):
 
     def test_path_attribute(self):
         self.assertEqual(self.data.path, self.lists_path)
+
+
+class TestCache(ConfigTest):
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.cache = data.BugwarriorData(self.lists_path).get_cache('my/target')
+
+    def test_load_missing(self):
+        self.assertEqual(self.cache.load(), {})
+
+    def test_save_load(self):
+        self.cache.save({'key': ['value']})
+
+        self.assertEqual(self.cache.load(), {'key': ['value']})
+        self.assertEqual(
+            os.path.dirname(self.cache.cachefile), self.lists_path)
+        permissions = oct(os.stat(self.cache.cachefile).st_mode & 0o777)
+        self.assertIn(permissions, ['0600', '0o600'])
+
+
+class TestStampedCache(ConfigTest):
+    def setUp(self):
+        super(TestStampedCache, self).setUp()
+        self.data = data.BugwarriorData(self.lists_path)
+
+    def pull(self, values):
+        """ Get values from a freshly loaded cache, returning them and the
+        keys which had to be computed. """
+        cache = data.StampedCache(self.data.get_cache('stamped'))
+        cache.load()
+        computed = []
+
+        def compute(key, value):
+            computed.append(key)
+            return value
+
+        results = dict(
+            (key, cache.get(key, stamp, lambda: compute(key, value)))
+            for key, (stamp, value) in values.items())
+        cache.save()
+        return results, sorted(computed)
+
+    def test_computed_only_when_stamp_changed(self):
+        self.assertEqual(
+            self.pull({'a': ([1, 1], 'one'), 'b': ([1, 1], 'two')}),
+            ({'a': 'one', 'b': 'two'}, ['a', 'b']))
+
+        # Unchanged values come from the cache.
+        self.assertEqual(
+            self.pull({'a': ([1, 1], 'new'), 'b': ([1, 2], 'new')}),
+            ({'a': 'one', 'b': 'new'}, ['b']))
+
+    def test_unused_values_expire(self):
+        self.pull({'a': ([1], 'one'), 'b': ([1], 'two')})
+        self.pull({'a': ([1], 'one')})
+
+        self.assertEqual(
+            self.pull({'b': ([1], 'new')}), ({'b': 'new'}, ['b']))
+
+    def test_incomplete_stamp_never_matches(self):
+        self.pull({'a': ([None, 1], 'one')})
+
+        self.assertEqual(
+            self.pull({'a': ([None, 1], 'new')}), ({'a': 'new'}, ['a']))
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import json
+import shutil
+import tempfile
 import unittest
 from six.moves import configparser
 
+import mock
+
 import taskw.task
 from bugwarrior import db
+from bugwarrior.data import BugwarriorData
 
 from .base import ConfigTest
 
@@ -41,6 +47,268 @@ class TestMergeLeft(unittest.TestCase):
         self.assertEqual(len(self.issue_dict['annotations']), 1)
 
 
+class TestTaskIndex(unittest.TestCase):
+    def setUp(self):
+        self.keys = {
+            'github': ('githuburl', 'githubtype'),
+            'jira': ('jiraurl',),
+        }
+        self.tasks = [
+            {'uuid': 'a', 'githuburl': 'https://example.com/1',
+             'githubtype': 'issue'},
+            {'uuid': 'b', 'githuburl': 'https://example.com/1',
+             'githubtype': 'pull_request'},
+            {'uuid': 'c', 'jiraurl': 'https://jira.example.com/FOO-1'},
+            {'uuid': 'd', 'jiraurl': 'https://jira.example.com/FOO-1'},
+            {'uuid': 'e', 'githuburl': 'https://example.com/2'},
+            {'uuid': 'f', 'description': 'Not managed by bugwarrior.'},
+        ]
+        self.index = db.build_task_index(self.tasks, self.keys)
+
+    def identify(self, issue):
+        return db.make_unique_identifier(self.keys, issue)
+
+    def test_unique_identifier(self):
+        issue = {
+            'description': 'Blah',
+            'githuburl': 'https://example.com/1',
+            'githubtype': 'issue',
+        }
+        self.assertEqual(
+            self.identify(issue),
+            ('github', ('https://example.com/1', 'issue')))
+
+    def test_managed_task_uuids(self):
+        self.assertEqual(
+            db.get_managed_task_uuids(self.index), set(['a', 'b', 'c', 'd']))
+
+    def test_find(self):
+        issue = {
+            'description': 'Blah',
+            'githuburl': 'https://example.com/1',
+            'githubtype': 'pull_request',
+        }
+        self.assertEqual(
+            db.find_taskwarrior_uuid(self.index, self.identify(issue), issue),
+            'b')
+
+    def test_not_found(self):
+        issue = {
+            'description': 'Blah',
+            'githuburl': 'https://example.com/2',
+            'githubtype': 'issue',
+        }
+        with self.assertRaises(db.NotFound):
+            db.find_taskwarrior_uuid(self.index, self.identify(issue), issue)
+
+    def test_multiple_matches(self):
+        issue = {
+            'description': 'Blah',
+            'jiraurl': 'https://jira.example.com/FOO-1',
+        }
+        with self.assertRaises(db.MultipleMatches):
+            db.find_taskwarrior_uuid(self.index, self.identify(issue), issue)
+
+
+class TestImportTasks(unittest.TestCase):
+    def setUp(self):
+        self.tw = mock.Mock()
+        self.tw.config.get_udas.return_value = {}
+        self.imported = []
+
+        def execute(command, filename):
+            with open(filename) as f:
+                self.imported.append([json.loads(line) for line in f])
+            return '', ''
+        self.tw._execute.side_effect = execute
+
+    def test_serialize_new_task(self):
+        task = db.serialize_task_for_import(self.tw, {
+            'description': 'Blah',
+            'priority': None,
+            'annotations': ['one', 'two'],
+        })
+        self.assertEqual(task['status'], 'pending')
+        self.assertIn('uuid', task)
+        self.assertNotIn('priority', task)
+        self.assertEqual(
+            [a['description'] for a in task['annotations']], ['one', 'two'])
+        self.assertNotEqual(
+            task['annotations'][0]['entry'], task['annotations'][1]['entry'])
+
+    def test_serialize_closed_task(self):
+        task = taskw.task.Task({
+            'uuid': '5f8b4c86-3d8e-4cd6-86a2-ae17b0e1a3fa',
+            'description': 'Blah',
+            'status': 'pending',
+            'urgency': 1.0,
+        })
+        task = db.serialize_task_for_import(self.tw, task, status='completed')
+        self.assertEqual(task['status'], 'completed')
+        self.assertIn('end', task)
+        self.assertNotIn('urgency', task)
+
+    def test_single_import(self):
+        writes = [('add', {'uuid': str(i)}) for i in range(3)]
+        db.import_tasks(self.tw, writes)
+        self.assertEqual(self.imported, [[{'uuid': '0'}, {'uuid': '1'},
+                                          {'uuid': '2'}]])
+
+    def test_failed_import_is_retried_per_task(self):
+        calls = []
+
+        def execute(command, filename):
+            with open(filename) as f:
+                tasks = [json.loads(line) for line in f]
+            calls.append(tasks)
+            if {'uuid': 'bad'} in tasks:
+                raise db.TaskwarriorError(['task'], 'refused', '', 1)
+            return '', ''
+        self.tw._execute.side_effect = execute
+
+        writes = [('add', {'uuid': 'good'}), ('modify', {'uuid': 'bad'})]
+        db.import_tasks(self.tw, writes)
+        self.assertEqual(calls, [
+            [{'uuid': 'good'}, {'uuid': 'bad'}],
+            [{'uuid': 'good'}],
+            [{'uuid': 'bad'}],
+        ])
+
+
+class MockedSynchronizeTest(unittest.TestCase):
+    """ Runs `synchronize` against a mocked taskwarrior holding one task,
+    recording the tasks written to it in `imported`. """
+    def setUp(self):
+        self.config = configparser.RawConfigParser()
+        self.config.add_section('general')
+        self.config.set('general', 'targets', 'my_service, other_service')
+        self.config.add_section('my_service')
+        self.config.set('my_service', 'service', 'github')
+        self.config.add_section('other_service')
+        self.config.set('other_service', 'service', 'jira')
+
+        self.tw = mock.Mock()
+        self.tw.config.get_udas.return_value = {}
+        self.tw.filter_tasks.return_value = [
+            taskw.task.Task({
+                'uuid': '5f8b4c86-3d8e-4cd6-86a2-ae17b0e1a3fa',
+                'description': 'Blah',
+                'status': 'pending',
+                'jiraurl': 'https://jira.example.com/FOO-1',
+            }),
+        ]
+        self.imported = []
+
+        def execute(command, filename):
+            with open(filename) as f:
+                self.imported.append([json.loads(line) for line in f])
+            return '', ''
+        self.tw._execute.side_effect = execute
+
+        keys = {'github': ('githuburl', 'githubtype'), 'jira': ('jiraurl',)}
+        for target, value in [
+            ('TaskWarriorShellout', self.tw),
+            ('build_key_list', keys),
+            ('build_uda_config_overrides', {}),
+            ('get_taskrc_path', '/dev/null'),
+        ]:
+            patcher = mock.patch('bugwarrior.db.' + target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestPipelinedSynchronize(MockedSynchronizeTest):
+    def test_flush_per_target(self):
+        from bugwarrior.services import (
+            SERVICE_FINISHED_ERROR, SERVICE_FINISHED_OK)
+        issue = {
+            'description': 'Blah blah blah.',
+            'githubtype': 'issue',
+            'githuburl': 'https://example.com',
+            'priority': 'M',
+        }
+        issue_generator = iter((
+            issue,
+            (SERVICE_FINISHED_OK, ('my_service', 1)),
+            (SERVICE_FINISHED_ERROR, ('other_service', IOError())),
+        ))
+
+        with self.assertRaises(RuntimeError):
+            db.synchronize(issue_generator, self.config, 'general')
+
+        # The github issue is written as soon as its target is done, and
+        # the jira task is not closed since its target failed.
+        self.assertEqual(len(self.imported), 1)
+        self.assertEqual(
+            [task['description'] for task in self.imported[0]],
+            ['Blah blah blah.'])
+
+
+class TestRefreshedSynchronize(MockedSynchronizeTest):
+    def setUp(self):
+        super(TestRefreshedSynchronize, self).setUp()
+        self.config.set('general', 'targets', 'other_service')
+        exported = self.tw.filter_tasks.return_value[0]
+        # The task as edited locally while the issues were being pulled.
+        self.fresh = taskw.task.Task(dict(
+            exported.serialized(), tags=['local'], project='home'))
+        self.tw.filter_tasks.side_effect = [
+            [exported], [self.fresh]]
+
+    def test_local_edits_kept(self):
+        issue = {
+            'description': 'Changed',
+            'jiraurl': 'https://jira.example.com/FOO-1',
+            'tags': ['remote'],
+            'priority': 'M',
+        }
+
+        db.synchronize(iter([issue]), self.config, 'general')
+
+        [[task]] = self.imported
+        self.assertEqual(task['description'], 'Changed')
+        self.assertEqual(task['project'], 'home')
+        self.assertEqual(task['tags'], ['local', 'remote'])
+
+    def test_locally_completed_not_closed(self):
+        self.fresh['status'] = 'completed'
+
+        db.synchronize(iter([]), self.config, 'general')
+
+        self.assertEqual(self.imported, [])
+
+
+class TestIncrementalSynchronize(MockedSynchronizeTest):
+    def setUp(self):
+        super(TestIncrementalSynchronize, self).setUp()
+        self.config.set('general', 'targets', 'other_service')
+        self.config.set('general', 'incremental_sync', 'True')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.config.data = BugwarriorData(tempdir)
+
+    def sync(self, description):
+        issue = {
+            'description': description,
+            'jiraurl': 'https://jira.example.com/FOO-1',
+            'priority': 'M',
+        }
+        self.imported = []
+        with mock.patch('bugwarrior.db.find_taskwarrior_uuid',
+                        wraps=db.find_taskwarrior_uuid) as find:
+            db.synchronize(iter([issue]), self.config, 'general')
+        return find.called, [
+            task['description'] for tasks in self.imported for task in tasks]
+
+    def test_unchanged_issues_skipped(self):
+        self.assertEqual(self.sync('Changed'), (True, ['Changed']))
+
+        # Unchanged upstream, the task is neither looked up nor closed.
+        self.assertEqual(self.sync('Changed'), (False, []))
+
+        self.assertEqual(self.sync('Changed again'), (True, ['Changed again']))
+
+
 class TestSynchronize(ConfigTest):
 
     def test_synchronize(self):
@@ -1,6 +1,7 @@
 from builtins import next
 import json
 
+import requests
 import responses
 
 from bugwarrior.services.gerrit import GerritService
@@ -81,3 +82,21 @@ class TestGerritIssue(AbstractServiceTest, ServiceTest):
             'tags': []}
 
         self.assertEqual(issue.get_taskwarrior_record(), expected)
+
+    @responses.activate
+    def test_auth_detected_before_redirect(self):
+        responses.add(
+            responses.HEAD,
+            self.SERVICE_CONFIG['gerrit.base_uri'] + '/a/',
+            status=302,
+            headers={
+                'www-authenticate': 'digest',
+                'location': self.SERVICE_CONFIG['gerrit.base_uri'] + '/login/',
+            })
+        responses.add(
+            responses.HEAD,
+            self.SERVICE_CONFIG['gerrit.base_uri'] + '/login/')
+
+        service = self.get_mock_service(GerritService)
+
+        self.assertIsInstance(service.session.auth, requests.auth.HTTPDigestAuth)
@@ -1,8 +1,10 @@
 from builtins import next
 import datetime
+import json
 from unittest import TestCase
 from six.moves.configparser import RawConfigParser
 
+import mock
 import pytz
 import responses
 
@@ -153,6 +155,156 @@ class TestGithubIssue(AbstractServiceTest, ServiceTest):
         self.assertEqual(issue.get_taskwarrior_record(), expected)
 
 
+class TestGithubConcurrency(ServiceTest):
+    SERVICE_CONFIG = {
+        'github.login': 'arbitrary_login',
+        'github.password': 'arbitrary_password',
+        'github.username': 'arbitrary_username',
+        'github.include_repos': 'arbitrary_repo',
+        'github.include_user_issues': 'False',
+        'github.concurrency': '4',
+    }
+
+    @responses.activate
+    def test_issues_keep_order(self):
+        service = self.get_mock_service(GithubService)
+        self.assertEqual(service.concurrency, 4)
+
+        numbers = list(range(1, 9))
+        records = []
+        for number in numbers:
+            record = ARBITRARY_ISSUE.copy()
+            record['number'] = number
+            record['url'] = '%s/%i' % (ARBITRARY_ISSUE['url'], number)
+            records.append(record)
+            self.add_response(
+                'https://api.github.com/repos/arbitrary_username/'
+                'arbitrary_repo/issues/%i/comments?per_page=100' % number,
+                json=[{
+                    'user': {'login': 'arbitrary_login'},
+                    'body': 'Comment on %i.' % number,
+                }])
+        self.add_response(
+            'https://api.github.com/repos/arbitrary_username/arbitrary_repo/issues?per_page=100',
+            json=records)
+
+        issues = list(service.issues())
+
+        self.assertEqual(
+            [issue.record['number'] for issue in issues], numbers)
+        self.assertEqual(
+            [issue.extra['annotations'] for issue in issues],
+            [[u'@arbitrary_login - Comment on %i.' % n] for n in numbers])
+
+
+class TestGithubCommentCache(ServiceTest):
+    SERVICE_CONFIG = {
+        'github.login': 'arbitrary_login',
+        'github.password': 'arbitrary_password',
+        'github.username': 'arbitrary_username',
+        'github.include_repos': 'arbitrary_repo',
+        'github.include_user_issues': 'False',
+    }
+    COMMENTS_URL = (
+        'https://api.github.com/repos/arbitrary_username/arbitrary_repo/'
+        'issues/10/comments?per_page=100')
+
+    def pull(self, record):
+        responses.reset()
+        self.add_response(
+            'https://api.github.com/repos/arbitrary_username/arbitrary_repo/issues?per_page=100',
+            json=[record])
+        self.add_response(self.COMMENTS_URL, json=[{
+            'user': {'login': 'arbitrary_login'},
+            'body': 'Comment %i.' % record['comments'],
+        }])
+        service = self.get_mock_service(GithubService)
+        issues = list(service.issues())
+        fetched = [call.request.url for call in responses.calls]
+        return issues[0].extra['annotations'], self.COMMENTS_URL in fetched
+
+    @responses.activate
+    def test_comments_fetched_only_when_changed(self):
+        record = dict(ARBITRARY_ISSUE, comments=1)
+        self.assertEqual(
+            self.pull(record), ([u'@arbitrary_login - Comment 1.'], True))
+
+        # Unchanged issue, the comments come from the cache.
+        self.assertEqual(
+            self.pull(dict(record)),
+            ([u'@arbitrary_login - Comment 1.'], False))
+
+        # A new comment was posted.
+        record = dict(record, comments=2)
+        self.assertEqual(
+            self.pull(record), ([u'@arbitrary_login - Comment 2.'], True))
+
+
+class TestGithubGraphQL(ServiceTest):
+    SERVICE_CONFIG = {
+        'github.login': 'arbitrary_login',
+        'github.token': 'arbitrary_token',
+        'github.username': 'arbitrary_username',
+        'github.api': 'graphql',
+        'github.include_user_issues': 'False',
+    }
+    NODE = {
+        '__typename': 'PullRequest',
+        'title': 'Hallo',
+        'url': 'https://github.com/arbitrary_username/arbitrary_repo/pull/1',
+        'number': 10,
+        'body': 'Something',
+        'state': 'CLOSED',
+        'createdAt': ARBITRARY_CREATED.isoformat(),
+        'updatedAt': ARBITRARY_UPDATED.isoformat(),
+        'closedAt': ARBITRARY_CLOSED.isoformat(),
+        'repository': {'nameWithOwner': 'arbitrary_username/arbitrary_repo'},
+        'author': {'login': 'arbitrary_login'},
+        'milestone': {'title': 'alpha'},
+        'assignees': {'nodes': []},
+        'labels': {'nodes': [{'name': 'bugfix'}]},
+        'comments': {
+            'totalCount': 1,
+            'nodes': [{
+                'author': {'login': 'arbitrary_login'},
+                'body': 'Arbitrary comment.',
+            }],
+        },
+    }
+
+    @responses.activate
+    def test_issues(self):
+        responses.add(
+            responses.POST, 'https://api.github.com/graphql',
+            json={'data': {'search': {
+                'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                'nodes': [self.NODE],
+            }}})
+        service = self.get_mock_service(GithubService)
+        comments_cache = service.config.data.get_cache(
+            'github-comments-unspecified')
+        comments_cache.save({'https://github.com/rest': 'cached'})
+
+        issues = list(service.issues())
+
+        self.assertEqual(len(responses.calls), 1)
+        body = json.loads(responses.calls[0].request.body)
+        self.assertEqual(
+            body['variables']['query'], 'user:arbitrary_username is:open')
+        self.assertEqual(len(issues), 1)
+        record = issues[0].get_taskwarrior_record()
+        self.assertEqual(record['annotations'],
+                         [u'@arbitrary_login - Arbitrary comment.'])
+        self.assertEqual(record['githubtype'], 'pull_request')
+        self.assertEqual(record['githubrepo'], 'arbitrary_username/arbitrary_repo')
+        self.assertEqual(record['githubmilestone'], 'alpha')
+        self.assertEqual(record['githubstate'], 'closed')
+        self.assertEqual(record['end'], ARBITRARY_CLOSED)
+        # Comments come along with the issues, the REST cache is left alone.
+        self.assertEqual(
+            comments_cache.load(), {'https://github.com/rest': 'cached'})
+
+
 class TestGithubIssueQuery(AbstractServiceTest, ServiceTest):
     maxDiff = None
     SERVICE_CONFIG = {
@@ -233,6 +385,20 @@ class TestGithubService(TestCase):
         self.assertEqual(service.client.session.headers['Authorization'],
                          "token 1234567890ABCDEF")
 
+    def test_graphql_comment_limit(self):
+        self.config.set('mygithub', 'github.graphql_comment_limit', '20')
+        with mock.patch('bugwarrior.services.github.die') as die:
+            GithubService.validate_config(self.service_config, 'mygithub')
+        self.assertFalse(die.called)
+
+        for limit in ('101', '0', 'many'):
+            self.config.set('mygithub', 'github.graphql_comment_limit', limit)
+            with mock.patch('bugwarrior.services.github.die') as die:
+                GithubService.validate_config(self.service_config, 'mygithub')
+            die.assert_called_once_with(
+                "[mygithub] has an invalid 'github.graphql_comment_limit', "
+                "it should be between 1 and 100")
+
     def test_default_host(self):
         """ Check that if github.host is not set, we default to github.com """
         service = GithubService(self.config, 'general', 'mygithub')
@@ -293,3 +459,23 @@ class TestGithubClient(TestCase):
         self.assertEquals(
             client._api_url('/some/path'),
             'https://github.example.com/api/v3/some/path')
+
+    @responses.activate
+    def test_conditional_requests(self):
+        url = 'https://api.github.com/user/issues?per_page=100'
+        client = GithubClient('github.com', {'token': 'xxxx'})
+        client.cached_responses = {}
+
+        responses.add(
+            responses.GET, url, json=[{'number': 1}],
+            headers={'ETag': '"abc"'})
+        self.assertEqual(client._getter(url), [{'number': 1}])
+
+        responses.reset()
+        responses.add(responses.GET, url, status=304)
+        client.cached_responses = client.fetched_responses
+        client.fetched_responses = {}
+        self.assertEqual(client._getter(url), [{'number': 1}])
+        self.assertEqual(
+            responses.calls[0].request.headers['If-None-Match'], '"abc"')
+        self.assertIn(url, client.fetched_responses)
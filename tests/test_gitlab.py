@@ -201,7 +201,8 @@ class TestGitlabIssue(AbstractServiceTest, ServiceTest):
     @responses.activate
     def test_issues(self):
         self.add_response(
-            'https://gitlab.example.com/api/v4/projects?simple=True&per_page=100&page=1',
+            'https://gitlab.example.com/api/v4/projects'
+            '?simple=True&pagination=keyset&order_by=id&sort=asc&per_page=100',
             json=[{
                 'id': 1,
                 'path': 'arbitrary_username/project',
@@ -253,3 +254,332 @@ class TestGitlabIssue(AbstractServiceTest, ServiceTest):
             'tags': []}
 
         self.assertEqual(issue.get_taskwarrior_record(), expected)
+
+    @responses.activate
+    def test_issues_concurrently(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={
+                'gitlab.concurrency': '4',
+                'gitlab.filter_merge_requests': 'True',
+            })
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects'
+            '?simple=True&pagination=keyset&order_by=id&sort=asc&per_page=100',
+            json=[{
+                'id': rid,
+                'path': 'arbitrary_username/project%i' % rid,
+                'web_url': 'example.com/%i' % rid,
+                'namespace': {'full_path': 'arbitrary_username'},
+            } for rid in range(1, 5)])
+
+        for rid in range(1, 5):
+            issue = dict(self.arbitrary_issue, id=rid, iid=rid)
+            self.add_response(
+                'https://gitlab.example.com/api/v4/projects/%i/issues'
+                '?state=opened&per_page=100&page=1' % rid,
+                json=[issue])
+            self.add_response(
+                'https://gitlab.example.com/api/v4/projects/%i/issues/%i/notes'
+                '?per_page=100&page=1' % (rid, rid),
+                json=[{
+                    'author': {'username': 'john_smith'},
+                    'body': 'Comment on %i.' % rid,
+                }])
+
+        issues = list(service.issues())
+
+        self.assertEqual(
+            [issue.extra['annotations'] for issue in issues],
+            [[u'@john_smith - Comment on %i.' % rid] for rid in range(1, 5)])
+
+    @responses.activate
+    def test_issues_scoped(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={
+                'gitlab.scope': 'assigned_to_me',
+                'gitlab.filter_merge_requests': 'True',
+                'gitlab.exclude_repos': 'arbitrary_username/excluded',
+            })
+        self.add_response(
+            'https://gitlab.example.com/api/v4/issues'
+            '?state=opened&scope=assigned_to_me&per_page=100&page=1',
+            json=[
+                self.arbitrary_issue,
+                dict(self.arbitrary_issue, id=43, iid=4, project_id=9),
+            ])
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects/8?simple=true',
+            json={
+                'id': 8,
+                'path': 'project',
+                'path_with_namespace': 'arbitrary_username/project',
+                'web_url': 'example.com',
+                'namespace': {'full_path': 'arbitrary_username'},
+            })
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects/9?simple=true',
+            json={
+                'id': 9,
+                'path': 'excluded',
+                'path_with_namespace': 'arbitrary_username/excluded',
+                'web_url': 'example.com/excluded',
+                'namespace': {'full_path': 'arbitrary_username'},
+            })
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects/8/issues/3/notes?per_page=100&page=1',
+            json=[])
+
+        issues = list(service.issues())
+
+        self.assertEqual(len(issues), 1)
+        self.assertEqual(
+            issues[0].get_taskwarrior_record()['gitlaburl'],
+            u'example.com/issues/3')
+        self.assertEqual(
+            [call.request.url.split('?')[0] for call in responses.calls
+             if '/projects' in call.request.url],
+            [
+                'https://gitlab.example.com/api/v4/projects/8',
+                'https://gitlab.example.com/api/v4/projects/9',
+                'https://gitlab.example.com/api/v4/projects/8/issues/3/notes',
+            ])
+
+    @responses.activate
+    def test_todos_scoped(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={
+                'gitlab.scope': 'assigned_to_me',
+                'gitlab.filter_merge_requests': 'True',
+                'gitlab.include_todos': 'True',
+                'gitlab.include_all_todos': 'False',
+                'gitlab.exclude_repos': 'arbitrary_username/excluded',
+            })
+        self.add_response(
+            'https://gitlab.example.com/api/v4/issues'
+            '?state=opened&scope=assigned_to_me&per_page=100&page=1',
+            json=[])
+        repos = [{
+            'id': 8,
+            'path': 'project',
+            'path_with_namespace': 'arbitrary_username/project',
+        }, {
+            'id': 9,
+            'path': 'excluded',
+            'path_with_namespace': 'arbitrary_username/excluded',
+        }]
+        for repo in repos:
+            self.add_response(
+                'https://gitlab.example.com/api/v4/projects/%d?simple=true'
+                % repo['id'],
+                json=repo)
+        self.add_response(
+            'https://gitlab.example.com/api/v4/todos'
+            '?state=pending&per_page=100&page=1',
+            json=[{
+                'id': repo['id'] * 10,
+                'project': repo,
+                'target_url': 'example.com/%d' % repo['id'],
+            } for repo in repos])
+
+        issues = list(service.issues())
+
+        self.assertEqual(
+            [issue.extra['issue_url'] for issue in issues],
+            ['example.com/8'])
+
+    @responses.activate
+    def test_fetch_paged_follows_next_page(self):
+        self.add_response(
+            'https://gitlab.example.com/api/v4/todos?state=pending&per_page=100&page=1',
+            json=[{'id': 1}], headers={'X-Next-Page': '2'})
+        self.add_response(
+            'https://gitlab.example.com/api/v4/todos?state=pending&per_page=100&page=2',
+            json=[{'id': 2}], headers={'X-Next-Page': ''})
+
+        self.assertEqual(
+            self.service._fetch_paged(
+                '{scheme}://{host}/api/v4/todos', state='pending'),
+            [{'id': 1}, {'id': 2}])
+
+    @responses.activate
+    def test_fetch_paged_follows_link(self):
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects?pagination=keyset&per_page=100',
+            json=[{'id': 1}],
+            headers={'Link': '<https://gitlab.example.com/api/v4/projects?id_after=1>; rel="next"'})
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects?id_after=1',
+            json=[{'id': 2}])
+
+        self.assertEqual(
+            self.service._fetch_paged(
+                '{scheme}://{host}/api/v4/projects', pagination='keyset'),
+            [{'id': 1}, {'id': 2}])
+
+    def snapshot_issues(self, count):
+        """ Return as many issues as a snapshot needs to be pulled
+        incrementally, and then some. """
+        return [
+            dict(self.arbitrary_issue, id=i, title=str(i))
+            for i in range(1, GitlabService.PER_PAGE + count + 1)]
+
+    @responses.activate
+    def test_fetch_paged_keeps_following_links(self):
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects'
+            '?pagination=keyset&per_page=100',
+            json=[{'id': 1}],
+            headers={'Link': '<https://gitlab.example.com/api/v4/projects'
+                             '?id_after=1>; rel="next"'})
+        self.add_response(
+            'https://gitlab.example.com/api/v4/projects?id_after=1',
+            json=[{'id': 2}], headers={'X-Next-Page': '3'})
+
+        self.assertEqual(
+            self.service._fetch_paged(
+                '{scheme}://{host}/api/v4/projects', pagination='keyset'),
+            [{'id': 1}, {'id': 2}])
+
+    @responses.activate
+    def test_incremental_pull(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={'gitlab.incremental': 'True'})
+        url = 'https://gitlab.example.com/api/v4/projects/8/issues'
+        issues = self.snapshot_issues(1)
+        self.add_response(
+            url + '?state=opened&per_page=100&page=1', json=issues)
+        self.assertEqual(len(service.get_repo_issues(8)), len(issues))
+        cache = service.config.data.get_cache('gitlab-snapshots-unspecified')
+        cache.save(service.fetched_snapshots)
+
+        responses.reset()
+        service = self.get_mock_service(
+            GitlabService, config_overrides={'gitlab.incremental': 'True'})
+        service.cached_snapshots = cache.load()
+        updated_after = service.cached_snapshots[
+            'projects/8/issues']['updated_after']
+        self.add_response(
+            url + '?state=all&updated_after=%s&per_page=100&page=1' % (
+                updated_after.replace(':', '%3A')),
+            json=[
+                dict(self.arbitrary_issue, id=1, state='closed'),
+                dict(self.arbitrary_issue, id=2, title='Two'),
+                dict(self.arbitrary_issue, id=1000, title='New'),
+            ])
+        self.add_response(
+            url + '?state=opened&per_page=1',
+            json=[{}], headers={'X-Total': str(len(issues))})
+
+        titles = [
+            issue['title'] for _, issue in service.get_repo_issues(8).values()]
+
+        self.assertEqual(
+            titles,
+            [issue['title'] for issue in issues[2:]] + ['Two', 'New'])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            service.fetched_snapshots['projects/8/issues']['pulls'], 1)
+
+    @responses.activate
+    def test_incremental_pull_small_snapshot(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={'gitlab.incremental': 'True'})
+        url = 'https://gitlab.example.com/api/v4/projects/8/issues'
+        service.cached_snapshots = {
+            'projects/8/issues': {
+                'updated_after': '2018-01-01T00:00:00Z',
+                'items': [dict(self.arbitrary_issue, id=1, title='One')],
+            },
+        }
+        # A single page of open issues is no more requests than a delta.
+        self.add_response(
+            url + '?state=opened&per_page=100&page=1',
+            json=[dict(self.arbitrary_issue, id=2, title='Two')])
+
+        issues = service.get_repo_issues(8)
+
+        self.assertEqual(
+            [issue['title'] for _, issue in issues.values()], ['Two'])
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_incremental_pull_without_total(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={
+                'gitlab.incremental': 'True',
+                'gitlab.scope': 'all',
+            })
+        url = 'https://gitlab.example.com/api/v4/issues'
+        updated_after = '2018-01-01T00:00:00Z'
+        issues = self.snapshot_issues(0)
+        service.cached_snapshots = {
+            'issues?scope=all': {
+                'updated_after': updated_after,
+                'pulls': 0,
+                'items': issues,
+            },
+        }
+        self.add_response(
+            url + '?scope=all&state=all&updated_after=%s'
+            '&per_page=100&page=1' % updated_after.replace(':', '%3A'),
+            json=[dict(self.arbitrary_issue, id=1, state='closed')])
+        # Gitlab leaves the total out of large collections.
+        self.add_response(
+            url + '?scope=all&state=opened&per_page=1', json=[{}])
+
+        # The merged snapshot is kept as long as its number is unknown...
+        self.assertEqual(
+            len(service.get_scoped_items('issues')), len(issues) - 1)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            service.fetched_snapshots['issues?scope=all']['pulls'], 1)
+
+        # ... until it was merged into often enough.
+        service.cached_snapshots['issues?scope=all']['pulls'] = (
+            GitlabService.SNAPSHOT_PULLS - 1)
+        self.add_response(
+            url + '?scope=all&state=opened&per_page=100&page=1',
+            json=issues[:3])
+
+        self.assertEqual(len(service.get_scoped_items('issues')), 3)
+        self.assertEqual(
+            service.fetched_snapshots['issues?scope=all']['pulls'], 0)
+
+    @responses.activate
+    def test_incremental_pull_drops_stale_items(self):
+        service = self.get_mock_service(
+            GitlabService, config_overrides={
+                'gitlab.incremental': 'True',
+                'gitlab.scope': 'assigned_to_me',
+            })
+        url = 'https://gitlab.example.com/api/v4/issues'
+        updated_after = '2018-01-01T00:00:00Z'
+        service.cached_snapshots = {
+            'issues?scope=assigned_to_me': {
+                'updated_after': updated_after,
+                'items': [
+                    dict(self.arbitrary_issue, id=1, title='Deleted'),
+                    dict(self.arbitrary_issue, id=2, title='Reassigned'),
+                ] + self.snapshot_issues(0)[2:],
+            },
+        }
+        # Neither deleted nor reassigned issues show up as updated.
+        self.add_response(
+            url + '?scope=assigned_to_me&state=all&updated_after=%s'
+            '&per_page=100&page=1' % updated_after.replace(':', '%3A'),
+            json=[])
+        self.add_response(
+            url + '?scope=assigned_to_me&state=opened&per_page=1',
+            json=[{}], headers={'X-Total': '98'})
+        self.add_response(
+            url + '?scope=assigned_to_me&state=opened&per_page=100&page=1',
+            json=[dict(self.arbitrary_issue, id=3, title='Kept')])
+
+        issues = service.get_scoped_items('issues')
+
+        self.assertEqual(
+            [issue['title'] for _, issue in issues.values()], ['Kept'])
+        self.assertEqual(
+            [item['title'] for item in service.fetched_snapshots[
+                'issues?scope=assigned_to_me']['items']],
+            ['Kept'])
@@ -2,21 +2,27 @@ from builtins import next
 from builtins import object
 
 import mock
-from collections import namedtuple
+import time
+from six.moves.configparser import RawConfigParser
 from dateutil.tz import datetime
 from dateutil.tz.tz import tzutc
 
+from bugwarrior.config import ServiceConfig
 from bugwarrior.services.jira import JiraService
 from .base import ServiceTest, AbstractServiceTest
 
 
+SERVER_INFO = {'versionNumbers': [8, 0, 0]}
+
+
 class FakeJiraClient(object):
+    _is_cloud = False
+
     def __init__(self, arbitrary_record):
         self.arbitrary_record = arbitrary_record
 
     def search_issues(self, *args, **kwargs):
-        Case = namedtuple('Case', ['raw', 'key'])
-        return [Case(self.arbitrary_record, self.arbitrary_record['key'])]
+        return {'issues': [self.arbitrary_record], 'total': 1}
 
     def comments(self, *args, **kwargs):
         return None
@@ -54,7 +60,8 @@ class TestJiraIssue(AbstractServiceTest, ServiceTest):
 
     def setUp(self):
         super(TestJiraIssue, self).setUp()
-        with mock.patch('jira.client.JIRA._get_json'):
+        with mock.patch('jira.client.JIRA._get_json',
+                        return_value=SERVER_INFO):
             self.service = self.get_mock_service(JiraService)
 
     def get_mock_service(self, *args, **kwargs):
@@ -177,3 +184,248 @@ class TestJiraIssue(AbstractServiceTest, ServiceTest):
             self.arbitrary_record_with_due
         )
         self.assertEqual(issue.get_due(), datetime.datetime(2016, 9, 23, 16, 8, tzinfo=tzutc()))
+
+    def test_inline_comments(self):
+        record = dict(self.arbitrary_record)
+        record['fields'] = dict(record['fields'], comment={
+            'total': 3,
+            'comments': [
+                {'author': {'name': 'one'}, 'body': 'Comment %i.' % i}
+                for i in range(3)
+            ],
+        })
+        self.service.jira = mock.Mock(_is_cloud=False)
+        self.service.jira.search_issues.return_value = {
+            'issues': [record], 'total': 1}
+        self.service.comment_limit = 2
+
+        issue = next(self.service.issues())
+
+        self.assertEqual(issue.get_taskwarrior_record()['annotations'], [
+            '@one - Comment 1.',
+            '@one - Comment 2.',
+        ])
+        self.assertFalse(self.service.jira.comments.called)
+
+    def test_search_fields(self):
+        with mock.patch('jira.client.JIRA._get_json',
+                        return_value=SERVER_INFO):
+            service = self.get_mock_service(JiraService, config_overrides={
+                'jira.import_labels_as_tags': 'True',
+                'jira.label_template':
+                    "{{fields.customfield_1}}_{{fields['customfield_2']}}"
+                    "_{{label}}",
+            })
+
+        self.assertEqual(service.get_search_fields(), ','.join([
+            'summary', 'timeestimate', 'priority', 'status', 'issuetype',
+            'created', 'duedate', 'fixVersions', 'labels', 'description',
+            'comment', 'Sprint', 'customfield_1', 'customfield_2',
+        ]))
+
+    def test_search_fields_unresolved_template(self):
+        with mock.patch('jira.client.JIRA._get_json',
+                        return_value=SERVER_INFO):
+            service = self.get_mock_service(JiraService, config_overrides={
+                'jira.import_labels_as_tags': 'True',
+                'jira.label_template': "{{fields[label]}}",
+            })
+
+        self.assertTrue(
+            service.get_search_fields().endswith(',Sprint,*navigable'))
+
+    def test_search_pages(self):
+        records = [{'key': 'DONUT-%i' % i} for i in range(7)]
+
+        def search_issues(query, startAt, maxResults, **kwargs):
+            # The server caps pages at 3 issues.
+            return {
+                'issues': records[startAt:startAt + min(maxResults, 3)],
+                'total': len(records),
+            }
+
+        self.service.jira = mock.Mock(_is_cloud=False)
+        self.service.jira.search_issues.side_effect = search_issues
+        self.service.concurrency = 2
+
+        self.assertEqual(
+            list(self.service.search('query', 'key')), records)
+        self.assertEqual(sorted(
+            call[1]['startAt']
+            for call in self.service.jira.search_issues.call_args_list
+        ), [0, 3, 6])
+
+    def test_search_pages_without_total(self):
+        records = [{'key': 'DONUT-%i' % i} for i in range(6)]
+
+        def search_issues(query, startAt, maxResults, **kwargs):
+            return {'issues': records[startAt:startAt + min(maxResults, 3)]}
+
+        self.service.jira = mock.Mock(_is_cloud=False)
+        self.service.jira.search_issues.side_effect = search_issues
+
+        self.assertEqual(
+            list(self.service.search('query', 'key')), records)
+        self.assertEqual([
+            call[1]['startAt']
+            for call in self.service.jira.search_issues.call_args_list
+        ], [0, 3, 6])
+
+    def test_search_cloud_pages(self):
+        records = [{'key': 'DONUT-%i' % i} for i in range(5)]
+
+        class FakeCloudClient(object):
+            _is_cloud = True
+
+            def search_issues(self, *args, **kwargs):
+                raise AssertionError("The search API is gone from jira cloud.")
+
+            def enhanced_search_issues(self, query, nextPageToken=None,
+                                       maxResults=50, **kwargs):
+                start = int(nextPageToken or 0)
+                end = start + min(maxResults, 2)
+                page = {'issues': records[start:end],
+                        'isLast': end >= len(records)}
+                if not page['isLast']:
+                    page['nextPageToken'] = str(end)
+                return page
+
+        self.service.jira = FakeCloudClient()
+
+        self.assertEqual(
+            list(self.service.search('query', 'key')), records)
+
+    def test_metadata_cache(self):
+        fields = [{'name': 'Sprint', 'id': 'customfield_1'}]
+        with mock.patch('jira.client.JIRA.server_info',
+                        return_value=SERVER_INFO), \
+                mock.patch('jira.client.JIRA.fields', return_value=fields):
+            service = super(TestJiraIssue, self).get_mock_service(
+                JiraService, config_overrides={
+                    'jira.import_sprints_as_tags': 'True',
+                })
+        self.assertEqual(service.sprint_field_names, ['customfield_1'])
+
+        service.config.refresh_metadata = False
+        self.assertEqual(service.get_cached_metadata(), {
+            'server_info': SERVER_INFO,
+            'fields': fields,
+        })
+
+        service.config.refresh_metadata = True
+        self.assertEqual(service.get_cached_metadata(), {})
+
+        service.config.refresh_metadata = False
+        service.metadata_ttl = 0
+        self.assertEqual(service.get_cached_metadata(), {})
+
+    def test_metadata_ttl_empty(self):
+        with mock.patch('jira.client.JIRA._get_json',
+                        return_value=SERVER_INFO):
+            service = self.get_mock_service(
+                JiraService, config_overrides={'jira.metadata_ttl': ''})
+        self.assertEqual(service.metadata_ttl, 86400)
+
+    def test_validate_metadata_ttl(self):
+        config = RawConfigParser()
+        config.add_section('myjira')
+        for option, value in self.SERVICE_CONFIG.items():
+            config.set('myjira', option, value)
+        service_config = ServiceConfig(
+            JiraService.CONFIG_PREFIX, config, 'myjira')
+        for ttl, valid in [('', True), ('0', True), ('3600', True),
+                           ('-1', False), ('day', False)]:
+            config.set('myjira', 'jira.metadata_ttl', ttl)
+            with mock.patch('bugwarrior.services.jira.die') as die:
+                JiraService.validate_config(service_config, 'myjira')
+            self.assertEqual(die.called, not valid, ttl)
+
+    def test_metadata_cache_after_search(self):
+        fields = [{'name': 'Sprint', 'id': 'customfield_1'}]
+        with mock.patch('jira.client.JIRA.server_info',
+                        return_value=SERVER_INFO):
+            service = super(TestJiraIssue, self).get_mock_service(JiraService)
+        service.config.refresh_metadata = False
+        self.assertEqual(service.get_cached_metadata(), {
+            'server_info': SERVER_INFO,
+        })
+
+        # Like jira itself, only look the fields up on the first search.
+        def search_issues(*args, **kwargs):
+            service.jira.fields()
+            return {'issues': [], 'total': 0}
+
+        with mock.patch('jira.client.JIRA.search_issues',
+                        side_effect=search_issues), \
+                mock.patch('jira.client.JIRA.fields', return_value=fields):
+            self.assertEqual(list(service.issues()), [])
+        self.assertEqual(service.get_cached_metadata(), {
+            'server_info': SERVER_INFO,
+            'fields': fields,
+        })
+
+    def test_incremental_pull(self):
+        self.service.incremental = True
+        self.service.search_fields = 'summary'
+        self.service.jira = mock.Mock(metadata={}, _is_cloud=False)
+        self.service.jira.comments.return_value = []
+
+        def pull(results):
+            def search_issues(query, **kwargs):
+                return {'issues': results[query], 'total': len(results[query])}
+            self.service.jira.search_issues.reset_mock()
+            self.service.jira.search_issues.side_effect = search_issues
+            with mock.patch.object(self.service, 'get_issue_for_record') \
+                    as get_issue_for_record:
+                list(self.service.issues())
+            return [
+                call[0][0] for call in get_issue_for_record.call_args_list]
+
+        def record(key, summary):
+            return {'key': key, 'fields': {'summary': summary}}
+
+        query = self.service.query
+        delta_query = '(%s) AND updated >= "-6m"' % query
+
+        # The first pull fetches every issue.
+        records = pull({query: [record('A-1', 'a'), record('A-2', 'b')]})
+        self.assertEqual(records, [record('A-1', 'a'), record('A-2', 'b')])
+
+        # A-1 left the results, A-2 was updated and A-3 entered them without
+        # being updated.
+        with mock.patch('time.time', return_value=time.time() + 30):
+            records = pull({
+                delta_query: [record('A-2', 'c')],
+                query: [{'key': 'A-2'}, {'key': 'A-3'}],
+                '(%s) AND key in (A-3)' % query: [record('A-3', 'd')],
+            })
+        self.assertEqual(records, [record('A-2', 'c'), record('A-3', 'd')])
+        self.assertEqual(
+            self.service.jira.search_issues.call_args_list[1][1]['fields'],
+            'key')
+
+    def test_incremental_pull_ordered_query(self):
+        def search_issues(query, **kwargs):
+            return {'issues': [{'key': 'A-1', 'fields': {}}], 'total': 1}
+
+        for query, delta_query in [
+            ('assignee = one order by priority DESC',
+             '(assignee = one) AND updated >= "-6m" order by priority DESC'),
+            ('ORDER BY key', 'updated >= "-6m" ORDER BY key'),
+        ]:
+            self.service.incremental = True
+            self.service.search_fields = 'summary'
+            self.service.query = query
+            self.service.jira = mock.Mock(metadata={}, _is_cloud=False)
+            self.service.jira.comments.return_value = []
+            self.service.jira.search_issues.side_effect = search_issues
+
+            with mock.patch.object(self.service, 'get_issue_for_record'):
+                list(self.service.issues())
+                with mock.patch('time.time', return_value=time.time() + 30):
+                    list(self.service.issues())
+
+            queries = [
+                call[0][0]
+                for call in self.service.jira.search_issues.call_args_list]
+            self.assertEqual(queries, [query, delta_query, query])
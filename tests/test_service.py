@@ -1,5 +1,8 @@
 import unittest
 
+import mock
+import responses
+
 from bugwarrior import config, services
 
 LONG_MESSAGE = """\
@@ -75,3 +78,151 @@ class TestIssue(unittest.TestCase):
         description = issue.build_default_description(LONG_MESSAGE)
         self.assertEqual(
             description, u'(bw)Is# - {message}'.format(message=LONG_MESSAGE))
+
+    def test_record_rendered_once(self):
+        issue = self.makeIssue()
+        issue.to_taskwarrior = mock.Mock(
+            side_effect=lambda: {'project': issue.extra.get('project')})
+        issue.get_default_description = mock.Mock(return_value='Issue')
+
+        issue.update_extra({'project': 'one'})
+        self.assertEqual(issue['project'], 'one')
+        self.assertEqual(issue['description'], 'Issue')
+        self.assertEqual(dict(issue)['tags'], [])
+        self.assertEqual(issue.to_taskwarrior.call_count, 1)
+
+        # Values come out as copies, which can be modified without affecting
+        # the issue.
+        issue['tags'].append('modified')
+        dict(issue)['tags'].append('modified')
+        issue.get_taskwarrior_record()['tags'].append('modified')
+        self.assertEqual(issue['tags'], [])
+
+        issue.update_extra({'project': 'two'})
+        self.assertEqual(issue['project'], 'two')
+        self.assertEqual(issue.to_taskwarrior.call_count, 2)
+
+    def test_origin_shared(self):
+        service = services.IssueService(self.config, 'general', 'test')
+        service.ISSUE_CLASS = services.Issue
+
+        with mock.patch.object(
+                service, 'get_templates', wraps=service.get_templates) as get:
+            first = service.get_issue_for_record(None)
+            second = service.get_issue_for_record(None)
+
+        self.assertIs(first.origin, second.origin)
+        self.assertEqual(first.origin['target'], 'test')
+        self.assertEqual(get.call_count, 1)
+
+    def test_templates_compiled_once(self):
+        template = services.get_template('{{project|upper}}')
+
+        self.assertIs(services.get_template('{{project|upper}}'), template)
+        self.assertEqual(template.render({'project': 'one'}), 'ONE')
+
+
+class TestServiceClient(unittest.TestCase):
+    def test_sessions_share_connection_pool(self):
+        first = services.ServiceClient()
+        second = services.ServiceClient()
+        first.session = services.get_http_session()
+        second.session = services.get_http_session()
+
+        self.assertIsNot(first.session, second.session)
+        self.assertIs(
+            first.session.get_adapter('https://example.com'),
+            second.session.get_adapter('https://example.org'))
+        self.assertEqual(
+            first.session.get_adapter('https://example.com')._pool_connections,
+            services.MAX_HTTP_HOSTS)
+
+    @responses.activate
+    def test_get_json(self):
+        responses.add(
+            responses.GET, 'https://example.com/api', json={'key': 'value'})
+        client = services.ServiceClient()
+
+        self.assertEqual(
+            client.get_json('https://example.com/api'), {'key': 'value'})
+
+    @responses.activate
+    def test_get_json_error(self):
+        responses.add(responses.GET, 'https://example.com/api', status=404)
+        client = services.ServiceClient()
+
+        with self.assertRaises(IOError):
+            client.get_json('https://example.com/api')
+
+
+class TestAggregateIssues(unittest.TestCase):
+    def setUp(self):
+        self.config = config.BugwarriorConfigParser()
+        self.config.add_section('general')
+        self.config.set('general', 'targets', 'one, two, three')
+        for target in ('one', 'two', 'three'):
+            self.config.add_section(target)
+            self.config.set(target, 'service', 'fake')
+
+    def test_thread_pool(self):
+        self.config.set('general', 'worker_pool', 'threads')
+        self.config.set('general', 'max_workers', '2')
+        self.config.set('general', 'pipelined', 'True')
+
+        def get_service(name):
+            service = mock.Mock()
+            service.side_effect = lambda conf, main_section, target: (
+                mock.Mock(issues=lambda: iter([mock.Mock(
+                    get_taskwarrior_record=lambda: target + ' issue')])))
+            return service
+
+        with mock.patch('bugwarrior.services.get_service', get_service):
+            results = list(services.aggregate_issues(
+                self.config, 'general', False))
+
+        issues = [r for r in results if not isinstance(r, tuple)]
+        finished = [r for r in results if isinstance(r, tuple)]
+        self.assertEqual(
+            sorted(issues), ['one issue', 'three issue', 'two issue'])
+        self.assertEqual(sorted(finished), [
+            (services.SERVICE_FINISHED_OK, (target, 1))
+            for target in ('one', 'three', 'two')])
+
+    def test_worker_uses_keyring_lock(self):
+        lock = mock.Mock()
+        locks = []
+
+        def get_service(name):
+            def service(conf, main_section, target):
+                locks.append(config._keyring_lock)
+                return mock.Mock(issues=lambda: iter([]))
+            return service
+
+        default_lock = config._keyring_lock
+        try:
+            with mock.patch('bugwarrior.services.get_service', get_service):
+                services._aggregate_issues(
+                    self.config, 'general', 'one', mock.Mock(), 'fake', lock)
+        finally:
+            config.use_keyring_lock(default_lock)
+
+        self.assertEqual(locks, [lock])
+
+    def test_worker_sends_records_in_batches(self):
+        issues = [
+            mock.Mock(get_taskwarrior_record=lambda i=i: {'description': i})
+            for i in range(3)
+        ]
+        service = mock.Mock(return_value=mock.Mock(issues=lambda: iter(issues)))
+        queue = mock.Mock()
+
+        with mock.patch('bugwarrior.services.get_service', return_value=service):
+            with mock.patch('bugwarrior.services.ISSUE_BATCH_SIZE', 2):
+                services._aggregate_issues(
+                    self.config, 'general', 'one', queue, 'fake')
+
+        self.assertEqual([c[0][0] for c in queue.put.call_args_list], [
+            [{'description': 0}, {'description': 1}],
+            [{'description': 2}],
+            (services.SERVICE_FINISHED_OK, ('one', 3)),
+        ])